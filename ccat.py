@@ -6,16 +6,37 @@
     -Christopher Welborn 09-26-2014
 """
 from __future__ import print_function
+import array
+import bisect
+import codecs
+import copy
+import hashlib
+import io
+import itertools
 import json
+import mmap
 import os
+import queue
 import re
+import signal
+import stat
+import struct
 import sys
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
 import docopt
 import pygments
-from pygments import formatters, lexers, styles
+import pygments.filter
+import pygments.lexer
+from pygments import formatters, lexers, styles, token
+from pygments.lexers.configs import IniLexer
+from pygments.lexers.data import JsonLexer
+from pygments.lexers.textfmts import KernelLogLexer
 
 NAME = 'ColorCat'
-VERSION = '0.4.4'
+VERSION = '0.5.0'
 VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
 SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
 SCRIPTDIR = os.path.abspath(sys.path[0])
@@ -25,7 +46,10 @@ USAGESTR = """{versionstr}
 Usage:
     {script} -h | -v
     {script} [FILE...] [-b style] [-f name] [-g | -l name] [-s name]
-         [-c | -C] [-D] [-n | -N] [-p] [--nosave]
+         [-c | -C] [-D] [-n | -N] [-p] [--cache] [--incremental] [--nosave]
+         [--time-budget secs] [--out spec...] [--fast]
+         [--grep pattern [--context n]] [--stream] [--metrics path]
+         [--files-from path [-0]] [--lines range]
     {script} (-F | -L | -S) [PATTERN]
 
 Options:
@@ -36,27 +60,95 @@ Options:
                                    pattern in the name or description.
     -b style,--background style  : Either 'light', or 'dark'.
                                    Changes the highlight style.
+    --cache                      : Cache lexed tokens on disk, so files can
+                                   be printed again with other styles or
+                                   formats without lexing them.
     -c,--colors                  : Force colors, even when piping output.
     -C,--nocolors                : Don't use colors?
+    -0,--null                    : Names in --files-from are separated by
+                                   null characters, like `find -print0`.
     -D,--debug                   : Debug mode. Show more info.
+    --fast                       : Use faster tokenizers, with the same
+                                   output, for JSON, INI, kernel logs,
+                                   and most languages that pygments
+                                   lexes with regexes.
     -f name,--format name        : Format for output.
                                    Default: terminal
     -F,--formatters              : List all available formatters.
+    --files-from path            : Print the files named in this file,
+                                   one per line, after any FILEs.
+                                   Use - to read names from stdin. Names
+                                   are read as they are printed, so the
+                                   list can be any size.
     -g,--guess                   : Guess lexer by file content.
+    --grep pattern               : Only print lines matching this regex
+                                   pattern, with line numbers. The file
+                                   is lexed up to the last match, or
+                                   only around the matches for lexers
+                                   like diff.
+    --context n                  : Lines of context to print around each
+                                   line matched by --grep.
+                                   Default: 0
     -h,--help                    : Show this help message.
+    --incremental                : Only re-lex the changed lines of files
+                                   printed before, saving the lexer state
+                                   in the cache directory. Lexers with
+                                   rules that match across lines (Python,
+                                   JS, JSON, Go, Rust, CSS, TOML, markdown,
+                                   and most others) lex the whole file.
     -l name,--lexer name         : Use this language/lexer name.
     -L,--lexers                  : List all known lexer names.
+    --lines range                : Only print this range of lines, like
+                                   10:20, 100:, or :50. For lexers that
+                                   can start at any line, lines before it
+                                   are lexed but not formatted, and the
+                                   rest of the file isn't read. Others
+                                   lex the whole file.
     -n,--linenos                 : Print line numbers.
     -N,--nolinenos               : Don't print line numbers.
                                    Overrides config setting.
+    --metrics path               : Write run metrics to this file when
+                                   done (files, sizes, lexers, lexing
+                                   time, errors), as JSON, or as
+                                   Prometheus text when the name ends
+                                   with .prom.
     --nosave                     : Don't save options in config file.
+    --out spec                   : Extra output, as FORMAT:DEST. Can be
+                                   used more than once, instead of the
+                                   normal output. Files are lexed once
+                                   for all outputs. DEST is - for
+                                   stdout, a directory ending with / for a
+                                   file per input, or a file name.
+                                   Example: --out html:dir/
     -p,--printnames              : Print file names.
     -s name,--style name         : Use this pygments style name.
     -S,--styles                  : List all known style names.
+    --stream                     : Print stdin line by line as it arrives,
+                                   like `tail -f log | ccat -l json`,
+                                   instead of waiting for end of file.
+                                   Use -l when the first lines are not
+                                   enough to guess the lexer.
+    --time-budget secs           : Maximum seconds to spend lexing each file.
+                                   The rest of a file that runs over is
+                                   printed as plain text.
     -v,--version                 : Show version.
 """.format(script=SCRIPT, versionstr=VERSIONSTR)
 
-CONFIG = os.path.join(SCRIPTDIR, 'ccat.json')
+# Config file, in the XDG config directory. Older versions kept it next
+# to the script, which is still used if that is the only one.
+CONFIG = os.path.join(
+    os.environ.get('XDG_CONFIG_HOME', None) or os.path.expanduser('~/.config'),
+    'ccat',
+    'ccat.json',
+)
+LEGACY_CONFIG = os.path.join(SCRIPTDIR, 'ccat.json')
+if os.path.exists(LEGACY_CONFIG) and not os.path.exists(CONFIG):
+    CONFIG = LEGACY_CONFIG
+# Directory for cached data, like lexed tokens.
+CACHEDIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', None) or os.path.expanduser('~/.cache'),
+    'ccat',
+)
 # Config options that can be saved and reloaded for later.
 CONFIGOPTS = (
     'background',
@@ -65,23 +157,63 @@ CONFIGOPTS = (
     'linenos',
     'style'
 )
-NON_JSON_KEYS = {'formatfilename', 'printargs'}
+NON_JSON_KEYS = {'outputs', 'printargs'}
 
 # Known terminal-friendly formatters.
 FORMATTERS = {
     'terminal': {
         'class': formatters.TerminalFormatter,
+        'ext': '.ansi',
     },
     '256': {
         'class': formatters.Terminal256Formatter,
+        'ext': '.ansi',
+    },
+    'truecolor': {
+        'class': formatters.TerminalTrueColorFormatter,
+        'ext': '.ansi',
     },
     'html': {
         'class': formatters.HtmlFormatter,
         'default_args': {'full': True},
+        'ext': '.html',
     }
 }
 
+# Default extension-based lexers. Pygments doesn't always make the right
+# guess, even with a known file extension.
+DEFAULT_EXT_LEXERS = {
+    '.json': 'json',
+    '.vim': 'vim',
+}
+
+# Scoped DOTALL flags, and `.|\n` alternatives, in a lexer rule.
+MULTILINE_DOT_REX = re.compile(r'\(\?[aiLmux]*s[aiLmux]*[:)]|\.\|\\n|\\n\|\.')
+# Character classes in a lexer rule (not escaped brackets).
+MULTILINE_CLASS_REX = re.compile(r'(?<!\\)\[\^?\]?(?:[^\]\\]|\\.)*\]')
+# Characters that a character class matching newlines is tested with.
+MULTILINE_CLASS_SAMPLES = 'aZ0_"\'*/#<>(){};=-'
+# Escaped newlines in a lexer rule (not escaped backslashes).
+MULTILINE_NEWLINE_REX = re.compile(r'(?<!\\)\\n')
+# Escapes that can match a newline in a lexer rule (not escaped
+# backslashes): \n, \s, \W, \D, and the newline's character codes.
+NEWLINE_ESCAPE_REX = re.compile(
+    r'(?<!\\)(?:\\\\)*\\(?:[nsWD]|x0[aA]|u000[aA]|0?12)'
+)
+# A newline escape at the end of a lexer rule.
+NEWLINE_END_REX = re.compile(r'(?<!\\)(?:\\\\)*\\n$')
+# Characters that str.splitlines() splits on.
+LINE_BREAKS = '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029'
+
 DEBUG = False
+# Parsed config files, as {path: ((mtime_ns, size), config)}.
+_config_cache = {}
+# Fast Lexer() classes by pygments Lexer() class, or None if there is none.
+_fast_classes = {}
+# Lexer() classes, and whether a rule can match across newlines.
+_multiline_classes = {}
+# Lexer() classes, and whether every line starts in the 'root' state.
+_synced_classes = {}
 
 
 def main(argd):
@@ -100,6 +232,39 @@ def main(argd):
     return 0 if (print_files(config) and save_config(config)) else 1
 
 
+def fast_lexer(lexer):
+    """ Return a faster Lexer() with the same options and tokens as a
+        pygments Lexer(), or the Lexer() itself if there is none.
+        JSON, INI, and kernel logs have hand-written tokenizers, and most
+        other RegexLexers can have the rules of each state joined into one
+        regex.
+    """
+    if isinstance(lexer, (FastJsonLexer, FastRegexLexer)):
+        return lexer
+    cls = type(lexer)
+    try:
+        fastcls = _fast_classes[cls]
+    except KeyError:
+        if cls is JsonLexer:
+            fastcls = FastJsonLexer
+        elif cls is IniLexer:
+            fastcls = FastIniLexer if lexer_has_rules(
+                lexer, 'root', FastIniLexer.rootpatterns
+            ) else None
+        elif cls is KernelLogLexer:
+            fastcls = FastKernelLogLexer if all(
+                lexer_has_rules(lexer, state, patterns)
+                for state, patterns in
+                FastKernelLogLexer.statepatterns.items()
+            ) else None
+        else:
+            fastcls = FastRegexLexer.subclass(lexer)
+        _fast_classes[cls] = fastcls
+    if fastcls is None:
+        return lexer
+    return fastcls(**lexer.options)
+
+
 def filename_is_stdin(s):
     """ Returns True if this is an acceptable name for using stdin.
         Like None or '-'.
@@ -118,10 +283,13 @@ def get_line_formatter(maxnum, linenos=True):
     if linenos:
         # Helps to format the line numbers. 1234 = len('1234') = .zfill(4)
         width = len(str(maxnum))
+        # The gutter's color codes are the same for every line.
+        prefix, suffix = colorcodes.colorword_codes(fore='cyan')
+        suffix = '{}: '.format(suffix)
 
         def formatline(i, l):
             """ Line formatter, with line numbers. """
-            return '{}: {}'.format(color(str(i).zfill(width), fore='cyan'), l)
+            return ''.join((prefix, str(i).zfill(width), suffix, l))
         return formatline
 
     def formatline(i, l):
@@ -130,50 +298,411 @@ def get_line_formatter(maxnum, linenos=True):
     return formatline
 
 
-def handle_file(filename, config):
-    """ Use `print_file` to print a single file, and print any errors.
-        A valid config object must be passed, given from parse_printer_config.
+def grep_windows(text, pat, context=0):
+    """ Find lines matching a compiled regex pattern, and the `context`
+        lines around them, without splitting the text into lines.
+        Returns a list of (firstline, lastline, start, end) windows, with
+        0-based line numbers and offsets into `text`. Overlapping and
+        adjacent windows are merged.
+    """
+    # Line by line matching, like grep.
+    pat = re.compile(pat.pattern, pat.flags | re.MULTILINE)
+    windows = []
+    pos = 0
+    lineno = 0
+    counted = 0
+    while True:
+        match = pat.search(text, pos)
+        if match is None:
+            break
+        linestart = text.rfind('\n', 0, match.start()) + 1
+        lineno += text.count('\n', counted, linestart)
+        counted = linestart
+        firstline, start = lineno, linestart
+        while (firstline > lineno - context) and start:
+            start = text.rfind('\n', 0, start - 1) + 1
+            firstline -= 1
+        lastline, end = lineno - 1, linestart
+        while (lastline < lineno + context) and (end < len(text)):
+            end = text.find('\n', end)
+            end = len(text) if end == -1 else end + 1
+            lastline += 1
+        if windows and (firstline <= windows[-1][1] + 1):
+            windows[-1] = (windows[-1][0], lastline, windows[-1][2], end)
+        else:
+            windows.append((firstline, lastline, start, end))
+        # Next match starts on the next line.
+        pos = text.find('\n', match.start())
+        if pos == -1:
+            break
+        pos += 1
+    return windows
+
+
+def line_window(text, firstline, lastline=None):
+    """ Return a window like `grep_windows()` for a range of 0-based line
+        numbers in `text`, where `lastline` is None for the end of the text.
+        Returns None if the text has no lines in the range.
+    """
+    if (lastline is not None) and (lastline < firstline):
+        return None
+    start = 0
+    for _ in range(firstline):
+        start = text.find('\n', start) + 1
+        if not start:
+            return None
+    if start >= len(text):
+        return None
+    end = start
+    last = firstline - 1
+    while ((lastline is None) or (last < lastline)) and (end < len(text)):
+        end = text.find('\n', end)
+        end = len(text) if end == -1 else end + 1
+        last += 1
+    return firstline, last, start, end
+
+
+def line_count(text):
+    """ Count the lines in `text` like `str.splitlines()` does, without the
+        list. A blank last line isn't counted, because `format_iter()`
+        doesn't print it.
+    """
+    if not text:
+        return 0
+    count = sum(text.count(c) for c in LINE_BREAKS) - text.count('\r\n')
+    if text[-1] not in LINE_BREAKS:
+        # The last line has no line break.
+        return count + 1
+    # Start of the last line break.
+    end = len(text) - (2 if text.endswith('\r\n') else 1)
+    if (not end) or (text[end - 1] in LINE_BREAKS):
+        # The last line is blank.
+        return count - 1
+    return count
+
+
+def handle_file(filename, printer, sinks=None, out=None):
+    """ Use a `Printer` to print a single file, and print any errors.
+        If `sinks` are given, the file is sent to them instead of stdout.
+        Output is written to `out` (a file object, or Writer()) when given.
+        BrokenPipeError is raised when stdout is closed.
     """
     try:
         with open(filename, 'r') as f:
-            if config['printnames']:
-                print(config['formatfilename'](filename))
-            if config['nocolors']:
-                # Colors have been disabled, there is no reason to
-                # use pygments at this point.
-                return pipe_file(f, **config['printargs'])
-
-            return print_file(f, **config['printargs'])
-    except EnvironmentError as ex:
+            if sinks:
+                return printer.render_fanout(f, sinks, name=filename)
+            return printer.render_to(f, out or sys.stdout, name=filename)
+    except BrokenPipeError:
+        # Nothing else can be printed, let print_files() stop.
+        raise
+    except (EnvironmentError, UnicodeDecodeError) as ex:
+        if isinstance(out, Writer):
+            # Print the error after the output that came before it.
+            out.flush(wait=True)
+        printer.count('errors', kind='read')
         print_status('Unable to read file:', filename, exc=ex)
     return False
 
 
-def handle_stdin(config):
-    """ Use `print_file` to handle stdin input, and print any errors.
+def handle_stdin(printer, config, sinks=None, out=None):
+    """ Use a `Printer` to handle stdin input, and print any errors.
         A valid config object must be passed, given from parse_printer_config.
+        If `sinks` are given, stdin is sent to them instead of stdout.
+        Output is written to `out` (a file object, or Writer()) when given.
+        BrokenPipeError is raised when stdout is closed.
     """
-    if handle_stdin.handled:
-        if config['debug']:
-            print_status('stdin was already read, skipping.')
-        return False
-
+    out = out or sys.stdout
     if config['stdin_tty'] and config['stdout_tty']:
         print_status('\nUsing stdin, press CTRL + D for end of file.')
 
-    if config['printnames']:
-        print(config['formatfilename']('stdin'))
-    handle_stdin.handled = True
+    try:
+        if sinks:
+            return printer.render_fanout(sys.stdin, sinks)
+        if config['stream']:
+            # Pipes and ttys are flushed after each line, files at the end.
+            try:
+                isfile = stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode)
+            except (OSError, ValueError):
+                isfile = False
+            return printer.stream_to(sys.stdin, out, flush=not isfile)
+        return printer.render_to(sys.stdin, out)
+    except BrokenPipeError:
+        raise
+    except (EnvironmentError, UnicodeDecodeError) as ex:
+        if isinstance(out, Writer):
+            out.flush(wait=True)
+        printer.count('errors', kind='read')
+        print_status('Unable to read stdin:', exc=ex)
+    return False
+
+
+def get_tokens_states(lexer, text, pos=0, stack=('root',), states=None):
+    """ Same as `RegexLexer.get_tokens_unprocessed()`, yielding
+        (index, tokentype, value), but lexing can start at any line
+        boundary (`pos`) with a saved state `stack`.
+        The state stack at the start of each line is saved in `states`,
+        as {line_offset: state_tuple}, before that line's first token is
+        yielded. The state at the end of the text is saved too, so lexing
+        can go on from there when the text ends in the middle of a line.
+        Only for lexers where `lexer_states_supported()` is True.
+    """
+    if states is None:
+        states = {}
+    if isinstance(lexer, FastRegexLexer):
+        yield from lexer.get_tokens_states(text, pos, stack, states)
+        return
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    while True:
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if not m:
+                continue
+            if action is not None:
+                if type(action) is token._TokenType:
+                    yield pos, action, m.group()
+                else:
+                    yield from action(lexer, m)
+            pos = m.end()
+            if new_state is not None:
+                _change_state(statestack, new_state)
+                statetokens = tokendefs[statestack[-1]]
+            if text[pos - 1:pos] == '\n':
+                states[pos] = tuple(statestack)
+            break
+        else:
+            # No rule matched.
+            try:
+                char = text[pos]
+            except IndexError:
+                break
+            if char == '\n':
+                # At EOL, reset state to "root".
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                yield pos, token.Whitespace, '\n'
+                pos += 1
+                states[pos] = ('root',)
+                continue
+            yield pos, token.Error, char
+            pos += 1
+    states[len(text)] = tuple(statestack)
+
+
+def iter_file_list(path, null=False):
+    """ Yield file names from a file (or stdin, for '-'), one per line, or
+        separated by null characters if `null` is True. Names are read as
+        they are needed, so the list can be any size.
+        Names are decoded like command line arguments (os.fsdecode), so
+        undecodable names still work.
+    """
+    if filename_is_stdin(path):
+        f = sys.stdin.buffer
+    else:
+        f = open(path, 'rb')
+    try:
+        if not null:
+            for line in f:
+                name = line.rstrip(b'\r\n')
+                if name:
+                    yield os.fsdecode(name)
+            return
+        pending = b''
+        while True:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            names = (pending + chunk).split(b'\0')
+            pending = names.pop()
+            for name in names:
+                if name:
+                    yield os.fsdecode(name)
+        if pending:
+            yield os.fsdecode(pending)
+    finally:
+        if f is not sys.stdin.buffer:
+            f.close()
+
+
+def lexer_input(lexer, content):
+    """ Apply the same preprocessing that `Lexer.get_tokens()` does to str
+        content (BOM, newlines, stripping, tabs), so token offsets from
+        `get_tokens_unprocessed()` match the returned text.
+    """
+    if content.startswith('\ufeff'):
+        content = content[len('\ufeff'):]
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    if lexer.stripall:
+        content = content.strip()
+    elif lexer.stripnl:
+        content = content.strip('\n')
+    if lexer.tabsize > 0:
+        content = content.expandtabs(lexer.tabsize)
+    if lexer.ensurenl and not content.endswith('\n'):
+        content += '\n'
+    return content
+
+
+def lexer_has_rules(lexer, state, patterns):
+    """ Returns True if a RegexLexer() state has rules with these regex
+        patterns, in this order.
+    """
+    rules = lexer._tokens.get(state, ())
+    return tuple(rule[0].__self__.pattern for rule in rules) == patterns
+
+
+def lexer_key(lexer):
+    """ Return a str that identifies a Lexer() and the options that
+        change its tokens, for cache keys.
+    """
+    return '\0'.join((
+        pygments.__version__,
+        type(lexer).__module__,
+        type(lexer).__name__,
+        repr(sorted(lexer.options.items())),
+    ))
+
+
+def lexer_resumable(lexer):
+    """ Returns True if lexing can be resumed from a saved state at the
+        start of any line with this Lexer(), and give the same tokens as
+        lexing the whole text.
+    """
+    return lexer_states_supported(lexer) and not lexer_multiline(lexer)
+
+
+def lexer_line_synced(lexer):
+    """ Returns True if every line starts in the 'root' state, and with a
+        new token, with this Lexer(), whatever the lines before it are.
+        Any line can be lexed without lexing the lines before it, and give
+        the same tokens as lexing the whole text.
+        That is when only rules in 'root' that keep the state can match a
+        newline, and only as the last character of a match. In any other
+        state, no rule matches a newline, and the lexer goes back to 'root'
+        when it reaches one. No rule may push 'root' on another state.
+    """
+    if not lexer_resumable(lexer):
+        return False
+    cls = type(lexer)
+    synced = _synced_classes.get(cls, None)
+    if synced is not None:
+        return synced
+    synced = True
+    for state, rules in lexer._tokens.items():
+        for rule in rules:
+            newstate = rule[2]
+            if isinstance(newstate, tuple) and ('root' in newstate):
+                synced = False
+                break
+            newlines = regex_newlines(rule[0].__self__)
+            if newlines is None:
+                continue
+            if (newlines != 'end') or (state != 'root') or (
+                    newstate is not None):
+                synced = False
+                break
+        if not synced:
+            break
+    if '_tokens' in cls.__dict__:
+        # Lexers with `token_variants` have their own rules.
+        _synced_classes[cls] = synced
+    return synced
+
+
+def lexer_multiline(lexer):
+    """ Returns True if a rule of this RegexLexer() can match text across
+        newlines (DOTALL, `(?:.|\\n)`, `[\\s\\S]`, `[^"]`, and so on).
+        Lexing can't be resumed from a saved state at the start of a line
+        for these, because a rule that matched before that line may match
+        differently when the lines after it change.
+    """
+    cls = type(lexer)
+    multiline = _multiline_classes.get(cls, None)
+    if multiline is not None:
+        return multiline
+    multiline = any(
+        regex_multiline(rule[0].__self__)
+        for rules in lexer._tokens.values()
+        for rule in rules
+    )
+    if '_tokens' in cls.__dict__:
+        # Lexers with `token_variants` have their own rules.
+        _multiline_classes[cls] = multiline
+    return multiline
+
+
+def lexer_states_supported(lexer):
+    """ Returns True if `get_tokens_states()` can lex for this Lexer(). """
+    return isinstance(lexer, FastRegexLexer) or (
+        isinstance(lexer, pygments.lexer.RegexLexer) and
+        (
+            type(lexer).get_tokens_unprocessed is
+            pygments.lexer.RegexLexer.get_tokens_unprocessed
+        )
+    )
+
 
-    if config['nocolors']:
-        # No colors, no pygments.
-        return pipe_file(sys.stdin, **config['printargs'])
-    return print_file(sys.stdin, **config['printargs'])
+def regex_multiline(regex):
+    """ Returns True if a compiled regex has a part that can match a
+        newline and other characters, like `(?:.|\\n)*` or `[^"]*`, or
+        can match a newline and then more of the next line, like `\\n\\w+`.
+        Character classes are checked by matching them against a few
+        characters, so this errs on the side of True.
+    """
+    pattern = regex.pattern
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('latin-1')
+    if (regex.flags & re.DOTALL) or MULTILINE_DOT_REX.search(pattern):
+        return True
+    for match in MULTILINE_CLASS_REX.finditer(pattern):
+        try:
+            with warnings.catch_warnings():
+                # Nested set warnings, already shown for the lexer's regex.
+                warnings.simplefilter('ignore', FutureWarning)
+                charclass = re.compile(match.group(0))
+        except re.error:
+            return True
+        if charclass.match('\n') and any(
+                charclass.match(c) for c in MULTILINE_CLASS_SAMPLES):
+            return True
+    # Ends of groups, and quantifiers, don't match anything after it.
+    bare = MULTILINE_CLASS_REX.sub('x', pattern).rstrip(')$*+?')
+    return any(
+        match.end() < len(bare)
+        for match in MULTILINE_NEWLINE_REX.finditer(bare)
+    )
 
 
-# Only read stdin once, but can be mixed in with other files.
-# This is set to True if stdin has been read already.
-handle_stdin.handled = False
+def regex_newlines(regex):
+    """ Returns where a compiled regex can match a newline: None if it
+        can't, 'end' if only as the last character of a match (like
+        `.*\\n`), or 'any'. Like `regex_multiline()`, this errs on the side
+        of 'any'.
+    """
+    pattern = regex.pattern
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode('latin-1')
+    if (regex.flags & re.DOTALL) or MULTILINE_DOT_REX.search(pattern):
+        return 'any'
+    for match in MULTILINE_CLASS_REX.finditer(pattern):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                charclass = re.compile(match.group(0))
+        except re.error:
+            return 'any'
+        if charclass.match('\n'):
+            return 'any'
+    bare = MULTILINE_CLASS_REX.sub('x', pattern)
+    if not NEWLINE_ESCAPE_REX.search(bare):
+        return None
+    # Ends of groups, and anchors, don't match anything after it.
+    bare = bare.rstrip(')$')
+    match = NEWLINE_END_REX.search(bare)
+    if (match is None) or NEWLINE_ESCAPE_REX.search(bare[:-2]):
+        return 'any'
+    return 'end'
 
 
 def load_config(argd):
@@ -181,18 +710,10 @@ def load_config(argd):
     """
     global DEBUG
     cmdline = {k.lstrip('-'): v for k, v in argd.items()}
-    if not os.path.exists(CONFIG):
+    config = read_config()
+    if config is None:
         return cmdline
 
-    # Load config as json.
-    try:
-        with open(CONFIG, 'r') as f:
-            config = json.load(f)
-    except EnvironmentError as ex:
-        raise InvalidConfig('Error loading config from', CONFIG, ex)
-    except ValueError as exparse:
-        raise InvalidConfig('Error parsing config from', CONFIG, exparse)
-
     # Merge the dicts.
     merged = {k: v for k, v in cmdline.items()}
     for k, v in config.items():
@@ -207,8 +728,8 @@ def load_config(argd):
         raise InvalidConfig(
             'Invalid lexers config',
             '({}) {!r}'.format(
-                type(config['lexers']).__name__,
-                config['lexers'],
+                type(config['ext_lexers']).__name__,
+                config['ext_lexers'],
             ),
             ValueError('Expecting a dict of {file_ext: lexer_name}'),
         )
@@ -223,8 +744,53 @@ def load_config(argd):
     return merged
 
 
+def parse_outputs(config, stylename):
+    """ Parse user --out specs (FORMAT:DEST) into a list of dicts for
+        `Sink()`:
+            {
+                'dest'      : '-' for stdout, a directory name ending
+                              with a path separator, or a file name.
+                'format'    : Name of formatter.
+                'formatter' : A pygments Formatter().
+                'linenos'   : Whether to print line numbers.
+            }
+        Raises InvalidArg for bad specs.
+    """
+    outputs = []
+    seen = set()
+    for spec in config.get('out', None) or []:
+        formatname, _, dest = spec.partition(':')
+        if not (formatname and dest):
+            raise InvalidArg('expecting FORMAT:DEST for --out', spec)
+        if formatname not in FORMATTERS:
+            raise InvalidArg('bad formatter name for --out', formatname)
+        if os.path.isdir(dest) and not dest.endswith(os.sep):
+            dest = '{}{}'.format(dest, os.sep)
+        if dest in seen:
+            raise InvalidArg('duplicate destination for --out', dest)
+        seen.add(dest)
+        ishtml = (formatname == 'html')
+        formatter = try_formatter(
+            formatname,
+            stylename,
+            background=config['background'],
+            args={'linenos': not config['nolinenos']} if ishtml else None,
+        )
+        if not formatter:
+            raise InvalidArg('bad style name', stylename)
+        outputs.append({
+            'dest': dest,
+            'format': formatname,
+            'formatter': formatter,
+            'linenos': config['linenos'] and not (
+                config['nolinenos'] or ishtml
+            ),
+        })
+    return outputs
+
+
 def parse_printer_config(argd):
-    """ Parse user args into usable objects for `print_files` and `print_file`.
+    """ Parse user args into usable objects for `print_files` and `Printer`.
         Returns None on error.
         On success returns a dict of:
             {
@@ -232,18 +798,32 @@ def parse_printer_config(argd):
                 'debug'      : Whether to print debug info.
                 'FILE'       : List of file names to print, where a None name
                                means to use stdin.
+                'files-from' : File with more names to print, or '-' for
+                               stdin, or None.
+                'null'       : Whether `files-from` names are separated by
+                               null characters instead of newlines.
                 'format'     : Name of formatter.
                 'lexers'     : Dict of {file_ext: lexer_name} to force lexers
                                for certain file extensions.
                 'nocolors'   : Whether to pipe output without pygments.
+                'outputs'    : Extra outputs, from `parse_outputs`.
                 'stdin_tty'  : Whether stdin is a tty.
                 'stdout_tty' : Whether stdout is a tty.
+                'stream'     : Whether to print stdin line by line.
                 'style'      : Style name for formatter.
-                'printargs'  : Arguments for `print_file`:
+                'printargs'  : Arguments for `Printer()`:
                     {
-                        'debug'    : Whether to print debug info.
-                        'formatter': A pygments Formatter().
-                        'linenos'  : Whether to print line numbers.
+                        'debug'      : Whether to print debug info.
+                        'ext_lexers' : Dict of {file_ext: lexer_name}.
+                        'fast'       : Whether to use fast lexers.
+                        'formatter'  : A pygments Formatter().
+                        'guess'      : Whether to always guess lexers.
+                        'lexer'      : User's lexer name, or None.
+                        'linenos'    : Whether to print line numbers.
+                        'lines'      : (first, last) lines to print, or
+                                       None for all of them.
+                        'nocolors'   : Whether to pipe without pygments.
+                        'printnames' : Whether to print file names.
                     }
             }
     """
@@ -286,21 +866,54 @@ def parse_printer_config(argd):
     # Disable ccat linenos automatically when piping output or for html.
     linenos = False if (config['nolinenos'] or ishtml) else config['linenos']
 
-    if not config['FILE']:
+    if not (config['FILE'] or config['files-from']):
         # No file names. Use stdin.
         config['FILE'] = [None]
 
-    if config['nocolors']:
-        config['formatfilename'] = '\n{}:'.format
-    else:
-        config['formatfilename'] = (
-            lambda s: '\n{}:'.format(color(s, fore='blue')))
+    config['outputs'] = parse_outputs(config, stylename)
+    if ishtml or config['outputs']:
+        for opt in ('grep', 'lines', 'stream'):
+            if config[opt]:
+                raise InvalidArg(
+                    '--{} is only for terminal output, not html/--out'.format(
+                        opt
+                    )
+                )
 
     # Arguments that apply to all files.
     config['printargs'] = {
+        'debug': config['debug'],
+        'ext_lexers': config.get('ext_lexers', None) or {},
+        'fast': config['fast'],
         'formatter': formatter,
+        'guess': config['guess'],
+        'lexer': config['lexer'],
         'linenos': linenos,
-        'debug': config['debug'],
+        'nocolors': config['nocolors'],
+        'printnames': config['printnames'],
+        'grep': try_repat(config['grep'], default=None),
+        'context': try_int(
+            config['context'],
+            name='--context',
+            default=0,
+            minimum=0,
+        ),
+        'time_budget': try_float(
+            config['time-budget'],
+            name='--time-budget',
+            minimum=0,
+        ),
+        'token_cache': TokenCache(
+            directory=os.path.join(CACHEDIR, 'tokens')
+        ) if config['cache'] else None,
+        'incremental': config['incremental'],
+        # The Printer keeps recent records in memory itself.
+        'record_cache': TokenCache(
+            maxsize=0,
+            directory=os.path.join(CACHEDIR, 'records'),
+        ) if config['incremental'] else None,
+        'metrics': Metrics() if config['metrics'] else None,
+        'lines': try_line_range(config['lines'], name='--lines'),
     }
     if DEBUG:
         print_debug(
@@ -309,51 +922,6 @@ def parse_printer_config(argd):
     return config
 
 
-def pipe_file(fileobject, **kwargs):
-    """ Just print the file to stdout. No formatting or anything.
-        Arguments:
-            fileobject  : An open fd to read from.
-
-        Keyword Arguments:
-            linenos     : Whether to print line numbers.
-    """
-    if not kwargs.get('linenos', False):
-        # Straight piping.
-        return pipe_file_simple(fileobject)
-    return pipe_file_linenos(fileobject)
-
-
-def pipe_file_linenos(fileobject):
-    """ Straight file -> stdout pipine, with line numbers. """
-    print_debug('Piping file with line numbers...')
-    try:
-        lines = fileobject.readlines()
-    except Exception as ex:
-        print_err('Unable to read the file: {}\n{}'.format(
-            fileobject.name,
-            ex))
-        return False
-
-    width = len(str(len(lines)))
-    for i, line in enumerate(lines):
-        print('{}: {}'.format(str(i).zfill(width), line), end='')
-
-    return True
-
-
-def pipe_file_simple(fileobject):
-    """ Straight file -> stdout piping. No frills/customization. """
-    print_debug('Piping file...')
-    try:
-        sys.stdout.buffer.write(fileobject.buffer.read())
-    except EnvironmentError as ex:
-        print_err('Unable to read the file: {}\n{}'.format(
-            fileobject.name,
-            ex))
-        return False
-    return True
-
-
 def print_debug(lbl, value=None):
     """ Prints a formatted debug msg. """
     if DEBUG:
@@ -371,86 +939,111 @@ def print_err(*args, **kwargs):
     print(*args, **kwargs)
 
 
-def print_file(fileobject, formatter, **kwargs):
-    """ Print a file's content with highlighting.
-        Arguments:
-            fileobject  : An open fd to read from.
-            lexer       : A Pygments Lexer(), pre-initialized.
-                          If None, then guess the lexer based on content.
-            formatter   : A Pygments Formatter(), pre-initialized.
-                          (saves from creating a formatter on each file)
-        Keyword Arguments:
-            linenos     : Print line numbers.
-    """
-    lexer = kwargs.get('lexer', None)
-    linenos = kwargs.get('linenos', False)
-
-    if not formatter:
-        raise ValueError('Need a formatter to use.')
-
-    try:
-        content = fileobject.read()
-    except Exception as ex:
-        print_status('Unable to read the file!:', exc=ex)
-        return False
-
-    if not lexer:
-        print_debug('guessed', True)
-        # try_lexer_guess() will fall back to 'text' lexer.
-        lexer = try_lexer_guess(content)
-
-    print_debug('lexer', lexer.name)
-    hilitelines = pygments.highlight(
-        content,
-        lexer,
-        formatter).splitlines()
-    # An extra newline that 'cat' doesn't print.
-    if not hilitelines[-1]:
-        hilitelines.pop(-1)
-
-    # Fix line number style for certain formatter styles.
-    if isinstance(formatter, formatters.HtmlFormatter):
-        # FIXME: Hack linenos style to match the main style.
-        hilitelines.append(
-            '<style>td.linenos { background-color: transparent; }</style>')
-
-    # Set up the line formatter also.
-    formatline = get_line_formatter(len(hilitelines), linenos=linenos)
-
-    # Print the lines.
-    for i, line in enumerate(hilitelines):
-        print(formatline(i + 1, line))
-
-    return True
-
-
 def print_files(config):
-    """ Print several files at once. Parses user string args into usable
-        objects for `print_file` (Lexer(), Formatter()).
-        Decides whether to disable all lexing (just piping input/output).
+    """ Print several files at once, using a single `Printer` built from
+        the parsed config (Formatter(), options, lexer caches).
         Returns True for success, or False for errors (which are printed).
         Arguments:
-            argd  : A docopt arg dict from the command line.
+            config  : A config dict from `parse_printer_config`.
     """
     if not config:
         # Any user arg errors have been printed, just return.
         return False
 
-    results = []
-    for filename in config['FILE']:
-        try:
-            filename = filename.strip()
-        except AttributeError:
-            # Filename is None.
-            pass
-        if not set_lexer(filename, config):
-            return False
-        if filename_is_stdin(filename):
-            results.append(handle_stdin(config))
-        else:
-            results.append(handle_file(filename, config))
-
-    return all(results)
+    printer = Printer(**config['printargs'])
+    sinks = [
+        Sink(printer, output['formatter'], output['dest'], output['linenos'])
+        for output in config['outputs']
+    ]
+    # Normal output is written from a background thread, while the next
+    # chunk is lexed and formatted.
+    out = None if sinks else Writer(sys.stdout)
+    # Only read stdin once, but it can be mixed in with other files.
+    stdin_read = False
+    filenames = (
+        f.strip() if f else f
+        for f in config['FILE']
+    )
+    if config['files-from']:
+        # Names from the list are used as-is, they may have spaces.
+        filenames = itertools.chain(
+            filenames,
+            iter_file_list(config['files-from'], null=config['null']),
+        )
+        # stdin can't be a file list and a file.
+        stdin_read = filename_is_stdin(config['files-from'])
+    # Failures are counted, not kept, the list of files may be unbounded.
+    failures = 0
+    try:
+        for filename in filenames:
+            if not filename_is_stdin(filename):
+                ok = handle_file(filename, printer, sinks=sinks, out=out)
+            elif stdin_read:
+                if config['debug']:
+                    print_status('stdin was already read, skipping.')
+                ok = False
+            else:
+                stdin_read = True
+                ok = handle_stdin(printer, config, sinks=sinks, out=out)
+            if not ok:
+                failures += 1
+    except InvalidLexer as ex:
+        # Lexer name was not transformed into a real Lexer().
+        printer.count('errors', kind='lexer')
+        print_status('Bad lexer name:', ex.val)
+        print_status('Use \'ccat --lexers\' to list known lexer names.')
+        return False
+    except BrokenPipeError:
+        # The reader went away (`ccat file | head`), the Writer has it.
+        pass
+    except EnvironmentError as ex:
+        # Files handle their own errors, this is the --files-from list.
+        printer.count('errors', kind='read')
+        print_status('Unable to read file list:', config['files-from'], exc=ex)
+        failures += 1
+    finally:
+        for sink in sinks:
+            if not sink.close():
+                printer.count('errors', kind='write')
+                print_status('Unable to write output:', sink.dest, sink.error)
+                failures += 1
+        if (out is not None) and (not out.close()):
+            failures += 1
+            if isinstance(out.error, BrokenPipeError):
+                printer.count('errors', kind='broken_pipe')
+            else:
+                printer.count('errors', kind='write')
+                print_status('Unable to write output:', 'stdout', out.error)
+        if printer.metrics is not None:
+            try:
+                printer.metrics.save(config['metrics'])
+            except EnvironmentError as ex:
+                print_status(
+                    'Unable to write metrics:',
+                    config['metrics'],
+                    exc=ex,
+                )
+                failures += 1
+
+    if (out is not None) and isinstance(out.error, BrokenPipeError):
+        # Stop quietly. Python flushes stdout at exit, which would fail
+        # again, so it is pointed at devnull.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.close(devnull)
+        return False
+    if out is not None:
+        printer.print_debug('Output', out.stats())
+    if printer.token_cache is not None:
+        printer.print_debug('Token cache', printer.token_cache.stats())
+    if len(styletables):
+        printer.print_debug('Style tables', styletables.stats())
+    for fallback in printer.fallbacks:
+        print_err(
+            'Time budget exceeded for {name} ({lexer}), '
+            'line {line} and after printed as plain text.'.format(**fallback)
+        )
+    return not failures
 
 
 def print_formatters(pat=None):
@@ -587,75 +1180,147 @@ def print_styles(pat=None):
     return 0
 
 
+def read_config(path=None):
+    """ Read a config file (CONFIG by default), and return a dict, or None
+        if it doesn't exist. Parsed files are cached, and only parsed again
+        when their mtime or size changes, for library and daemon use.
+        Raises InvalidConfig for unreadable or invalid files.
+    """
+    path = path or CONFIG
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    except EnvironmentError as ex:
+        raise InvalidConfig('Error loading config from', path, ex)
+    stamp = (st.st_mtime_ns, st.st_size)
+    cached = _config_cache.get(path, None)
+    if (cached is not None) and (cached[0] == stamp):
+        return copy.deepcopy(cached[1])
+    try:
+        with open(path, 'r') as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return None
+    except EnvironmentError as ex:
+        raise InvalidConfig('Error loading config from', path, ex)
+    except ValueError as exparse:
+        raise InvalidConfig('Error parsing config from', path, exparse)
+    if not isinstance(config, dict):
+        raise InvalidConfig(
+            'Error parsing config from',
+            path,
+            ValueError('Expecting a JSON object.'),
+        )
+    _config_cache[path] = (stamp, config)
+    return copy.deepcopy(config)
+
+
 def save_config(config):
-    """ Save the config object as json. """
+    """ Save the config object as json, if the saved options changed.
+        The file is written to a temp file and renamed, so other ccat
+        processes never read a partial file.
+    """
     config = {k: v for k, v in config.items() if v and (k in CONFIGOPTS)}
     if not config:
         print_debug('No config to save.')
         return False
+    try:
+        saved = read_config() or {}
+    except InvalidConfig as ex:
+        # A bad config file is replaced.
+        print_debug('Replacing config', str(ex))
+        saved = {}
+    saved = {k: v for k, v in saved.items() if v and (k in CONFIGOPTS)}
+    if saved == config:
+        print_debug('Config is unchanged.')
+        return True
     print_debug('Saving config', value=config)
     try:
-        with open(CONFIG, 'w') as f:
-            json.dump(config, f, indent=4, sort_keys=True)
+        data = json.dumps(config, indent=4, sort_keys=True)
     except TypeError as ex:
-        print_err('Error saving config to:', CONFIG, exc=ex)
+        print_status('Error saving config to:', CONFIG, exc=ex)
+        return False
+    tmppath = '{}.{}.tmp'.format(CONFIG, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(CONFIG), exist_ok=True)
+        with open(tmppath, 'w') as f:
+            f.write(data)
+        os.replace(tmppath, CONFIG)
+    except EnvironmentError as ex:
+        print_status('Error saving config to:', CONFIG, exc=ex)
+        try:
+            os.remove(tmppath)
+        except EnvironmentError:
+            pass
         return False
     return True
 
 
-def set_lexer(filename, config):
-    """ Set the printargs Lexer() for an individual file.
-        A valid config object must be passed, given from parse_printer_config.
-        Returns True on success, or False on fatal error.
+def try_float(s, name='value', default=None, minimum=None):
+    """ Try parsing a string as a float.
+        Passing None will simply return `default`.
+        Invalid numbers, or numbers below `minimum`, will raise InvalidArg.
     """
-    if config['guess']:
-        # Forced guess from the user.
-        # print_file() will try to guess the lexer from the content.
-        config['printargs']['lexer'] = None
-        return True
-
-    if config['lexer']:
-        # Transform the user's lexer name into a real Lexer().
-        # Filename may be stdin (None, or '-', or anything falsey).
-        config['printargs']['lexer'] = try_lexer(
-            config['lexer'],
-            filename=filename)
-        if config['printargs']['lexer']:
-            return True
+    if s is None:
+        return default
+    try:
+        val = float(s)
+    except ValueError as ex:
+        raise InvalidArg('bad number for {}: {}'.format(name, s)) from ex
+    if (minimum is not None) and (val <= minimum):
+        raise InvalidArg(
+            'bad number for {}, must be more than {}: {}'.format(
+                name,
+                minimum,
+                s,
+            )
+        )
+    return val
 
-        # Lexer name was not transformed into a real Lexer().
-        print_status('Bad lexer name:', config['lexer'])
-        print_status('Use \'ccat --lexers\' to list known lexer names.')
-        return False
-    # No lexer name was given, guess it or set known lexers by extension.
-    # Pygments doesn't always make the right guess, even with a known file ext.
-    # If it's not one of these extensions I'll force a guess later by setting
-    # it to `None`.
-    if not filename:
-        # No file to check extension.
-        return True
 
-    ext = os.path.splitext(filename)[-1].lower()
-    # Try the user's `lexers` config first.
-    lexername = config.get('ext_lexers', {}).get(ext, None)
-    if lexername is None:
-        # Default extension based lexers.
-        lexername = {
-            '.json': 'json',
-            '.vim': 'vim',
-        }.get(ext, None)
-        if lexername is not None:
-            print_debug(
-                'Set lexer name by default extension: {!r}'.format(ext),
-                value=lexername,
+def try_int(s, name='value', default=None, minimum=None):
+    """ Try parsing a string as an int.
+        Passing None will simply return `default`.
+        Invalid numbers, or numbers below `minimum`, will raise InvalidArg.
+    """
+    if s is None:
+        return default
+    try:
+        val = int(s)
+    except ValueError as ex:
+        raise InvalidArg('bad number for {}: {}'.format(name, s)) from ex
+    if (minimum is not None) and (val < minimum):
+        raise InvalidArg(
+            'bad number for {}, must be at least {}: {}'.format(
+                name,
+                minimum,
+                s,
             )
-    else:
-        print_debug(
-            'Set lexer name by user config extension: {!r}'.format(ext),
-            value=lexername,
         )
-    config['printargs']['lexer'] = try_lexer(lexername, filename=filename)
-    return True
+    return val
+
+
+def try_line_range(s, name='value'):
+    """ Try parsing a line range, like '10:20', '10:', ':20', or '10'.
+        Returns (first, last) line numbers, starting at 1, where `last` is
+        None for the end of the file.
+        Passing None will simply return None.
+        Invalid ranges will raise InvalidArg.
+    """
+    if not s:
+        return None
+    first, sep, last = s.partition(':')
+    first = try_int(first.strip() or None, name=name, default=1, minimum=1)
+    if not sep:
+        return first, first
+    last = try_int(
+        last.strip() or None,
+        name=name,
+        default=None,
+        minimum=first,
+    )
+    return first, last
 
 
 def try_formatter(formattername, stylename, background=None, args=None):
@@ -692,22 +1357,24 @@ def try_formatter(formattername, stylename, background=None, args=None):
     return formatter
 
 
-def try_lexer_guess(content):
+def try_lexer_guess(content, fast=False):
     """ Try getting a pygments lexer by content.
         If it can't be guessed, return the default 'text' lexer.
+        If `fast` is True, a `fast_lexer()` is returned when there is one.
     """
     try:
         lexer = lexers.guess_lexer(content)
     except pygments.util.ClassNotFound:
         return lexers.get_lexer_by_name('text')
-    return lexer
+    return fast_lexer(lexer) if fast else lexer
 
 
-def try_lexer(name, filename=None):
+def try_lexer(name, filename=None, fast=False):
     """ Try getting a pygments lexer by name.
         None is returned if no lexer can be found by that name,
         unless 'filename' is given. If 'filename' is given the lexer
         is guessed by file name.
+        If `fast` is True, a `fast_lexer()` is returned when there is one.
         Ultimately returns None on failure.
     """
     if not name:
@@ -719,7 +1386,7 @@ def try_lexer(name, filename=None):
         except pygments.util.ClassNotFound:
             return None
         # Retrieved by file name only.
-        return lexer
+        return fast_lexer(lexer) if fast else lexer
 
     try:
         lexer = lexers.get_lexer_by_name(name)
@@ -732,9 +1399,9 @@ def try_lexer(name, filename=None):
         except pygments.util.ClassNotFound:
             return None
         # Retrieved by falling back to file name.
-        return lexer
+        return fast_lexer(lexer) if fast else lexer
     # Successful lexer by name.
-    return lexer
+    return fast_lexer(lexer) if fast else lexer
 
 
 def try_repat(s, default=None):
@@ -752,6 +1419,88 @@ def try_repat(s, default=None):
     return p
 
 
+def write_all(fileobj, data):
+    """ Write all of `data` to a binary file object, and return the number
+        of bytes written. Raw files (sys.stdout.buffer with
+        PYTHONUNBUFFERED=1) may only write part of it at a time.
+    """
+    view = memoryview(data)
+    while view:
+        written = fileobj.write(view)
+        if written is None:
+            # File objects that don't say, write everything.
+            break
+        view = view[written:]
+    return len(data)
+
+
+def _change_state(statestack, new_state):
+    """ Apply a RegexLexer rule's state transition to a state stack (list),
+        in place, like `RegexLexer.get_tokens_unprocessed()` does.
+    """
+    if isinstance(new_state, tuple):
+        for state in new_state:
+            if state == '#pop':
+                if len(statestack) > 1:
+                    statestack.pop()
+            elif state == '#push':
+                statestack.append(statestack[-1])
+            else:
+                statestack.append(state)
+    elif isinstance(new_state, int):
+        # Pop, but keep at least one state on the stack.
+        if abs(new_state) >= len(statestack):
+            del statestack[1:]
+        else:
+            del statestack[new_state:]
+    elif new_state == '#push':
+        statestack.append(statestack[-1])
+    else:
+        raise ValueError('Wrong state def: {!r}'.format(new_state))
+
+
+def _common_prefix(a, b):
+    """ Return the length of the common prefix of two sequences.
+        Uses a binary search, so the comparisons are done in C.
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _stripped_lines(lexer, content):
+    """ Return the number of leading lines that `lexer_input()` strips from
+        content, to find real line numbers for lexed text.
+    """
+    if not (lexer.stripall or lexer.stripnl):
+        return 0
+    if content.startswith('\ufeff'):
+        content = content[len('\ufeff'):]
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    if lexer.stripall:
+        stripped = content[:len(content) - len(content.lstrip())]
+    else:
+        stripped = content[:len(content) - len(content.lstrip('\n'))]
+    return stripped.count('\n')
+
+
+def _drop_index(tokens):
+    """ Turn (index, tokentype, value) tokens into (tokentype, value),
+        passing the stream's return value through.
+    """
+    while True:
+        try:
+            _, ttype, value = next(tokens)
+        except StopIteration as stop:
+            return stop.value
+        yield ttype, value
+
+
 class ColorCodes(object):
     # FIXME: The 'Colr' library may be used in the future, it provides several
     #        more options when working with colored output on linux.
@@ -813,13 +1562,23 @@ class ColorCodes(object):
         self.extbackformat = '\033[48;5;{}m'
         self.extbackfmt = lambda s: self.extbackformat.format(s)
 
+        # Cached codes, by (fore, back, style).
+        self._codecache = {}
+        # Cached (prefix, suffix) codes for colorword, by (fore, back, style).
+        self._wordcache = {}
+
         # Shortcuts to most used functions.
         self.word = self.colorword
 
     def color_code(self, fore=None, back=None, style=None):
-        """ Return the code for this style/color
+        """ Return the code for this style/color.
+            Codes are cached per (fore, back, style).
         """
-
+        key = (fore, back, style)
+        try:
+            return self._codecache[key]
+        except KeyError:
+            pass
         codes = []
         userstyles = {'style': style, 'back': back, 'fore': fore}
         for stype in userstyles:
@@ -830,7 +1589,8 @@ class ColorCodes(object):
                 # Reset codes come first (or they will override other styles)
                 codes.append(code)
 
-        return self.codefmt(';'.join(codes))
+        code = self._codecache[key] = self.codefmt(';'.join(codes))
+        return code
 
     def color256(self, text=None, fore=None, back=None, style=None):
         """ Return a colored word using the extended 256 colors.
@@ -866,19 +1626,31 @@ class ColorCodes(object):
 
     def colorword(self, text=None, fore=None, back=None, style=None):
         """ Same as colorize, but adds a style->reset_all after it. """
-        text = text or ''
-        colorized = self.colorize(
-            text=text,
-            style=style,
+        prefix, suffix = self.colorword_codes(
+            fore=fore,
             back=back,
-            fore=fore
+            style=style
         )
-        s = ''.join((
-            colorized,
-            self.color_code(style='reset_all'),
-            self.closing
-        ))
-        return s
+        return ''.join((prefix, text or '', suffix))
+
+    def colorword_codes(self, fore=None, back=None, style=None):
+        """ Return the (prefix, suffix) codes that colorword wraps text with.
+            Codes are cached per (fore, back, style).
+        """
+        key = (fore, back, style)
+        try:
+            return self._wordcache[key]
+        except KeyError:
+            pass
+        codes = self._wordcache[key] = (
+            self.color_code(style=style, back=back, fore=fore),
+            ''.join((
+                self.closing,
+                self.color_code(style='reset_all'),
+                self.closing
+            )),
+        )
+        return codes
 
     def make_256color(self, colortype, val):
         """ Create a 256 color code based on type ('fore' or 'back')
@@ -915,23 +1687,3258 @@ class ColorCodes(object):
 
 
 # Alias, convenience function for ColorCodes().
-color = ColorCodes().colorword
-
+colorcodes = ColorCodes()
+color = colorcodes.colorword
 
-class _ColorDocoptExit(SystemExit):
 
-    """ Custom DocoptExit class, colorizes the help text. """
+class FastJsonLexer(JsonLexer):
+    """ A JsonLexer() that splits text into tokens with a regex, instead of
+        looking at one character at a time. Tokens are the same as the
+        JsonLexer's, including its handling of comments and bad JSON.
+    """
+    # A string, with an end quote.
+    stringrex = re.compile(
+        r"""
+        "[^"\\]*(?:
+            (?:
+                \\u[0-9a-fA-F]{4}
+                |\\u[0-9a-fA-F]{0,3}[^0-9a-fA-F]
+                |\\[^u]
+            )[^"\\]*
+        )*"
+        """,
+        re.VERBOSE,
+    )
+    # Every token, in the order the JsonLexer() would find them. Strings
+    # and comments that don't end are errors that run to the end of text.
+    tokenrex = re.compile(
+        r"""
+        [ \n\r\t]+
+        |""" + stringrex.pattern + r"""
+        |[{}\[\],]+
+        |:[{}\[\],]*
+        |[-0-9][-0-9.eE+]*
+        |[fnt][truefalsn]*
+        |//[^\n]*
+        |/\*[\s\S]*?\*/
+        |"[\s\S]*
+        |/\*[\s\S]*
+        |[\s\S]
+        """,
+        re.VERBOSE,
+    )
+    floatrex = re.compile(r'[.eE+]')
+    # Token types, by first character. Strings, colons, and comments are
+    # handled in `get_tokens_unprocessed`, anything else is an error.
+    firsttypes = dict(
+        [(c, token.Whitespace) for c in ' \n\r\t'] +
+        [(c, token.Punctuation) for c in '{}[],:'] +
+        [(c, token.Number.Integer) for c in '-0123456789'] +
+        [(c, token.Keyword.Constant) for c in 'fnt'] +
+        [('"', token.String.Double), ('/', token.Comment)]
+    )
+    # Number of characters to find tokens in at a time.
+    chunk_size = 65536
+
+    def get_tokens_unprocessed(self, text):
+        """ Parse JSON data. """
+        Whitespace = token.Whitespace
+        Integer = token.Number.Integer
+        String = token.String.Double
+        Comment = token.Comment
+        Error = token.Error
+        firsttypes = self.firsttypes
+        isfloat = self.floatrex.search
+        length = len(text)
+        # Strings, and the whitespace and comments after them, wait here
+        # until the next token says whether they are object keys.
+        queue = []
+        pos = 0
+        for value in itertools.chain.from_iterable(self._iter_chunks(text)):
+            ttype = firsttypes.get(value[0], Error)
+            if ttype is Whitespace:
+                if queue:
+                    queue.append((pos, ttype, value))
+                else:
+                    yield pos, ttype, value
+                pos += len(value)
+                continue
+            if ttype is String:
+                # Only the last token can be a string that never ends.
+                if (pos + len(value) < length) or (
+                        self.stringrex.fullmatch(value) is not None):
+                    queue.append((pos, ttype, value))
+                    pos += len(value)
+                    continue
+                ttype = Error
+            elif ttype is Comment:
+                if value.startswith('//'):
+                    ttype = token.Comment.Single
+                elif (len(value) > 3) and value.endswith('*/'):
+                    ttype = token.Comment.Multiline
+                else:
+                    # A lone /, or a comment that never ends.
+                    ttype = Error
+                if ttype is not Error:
+                    if queue:
+                        queue.append((pos, ttype, value))
+                    else:
+                        yield pos, ttype, value
+                    pos += len(value)
+                    continue
+            if queue:
+                if value[0] == ':':
+                    for start, qtype, qvalue in queue:
+                        if qtype is String:
+                            qtype = token.Name.Tag
+                        yield start, qtype, qvalue
+                else:
+                    yield from queue
+                queue.clear()
+            if (ttype is Integer) and (isfloat(value) is not None):
+                ttype = token.Number.Float
+            yield pos, ttype, value
+            pos += len(value)
+        yield from queue
+
+    def _iter_chunks(self, text):
+        """ Yield lists of token values (str) from text, a chunk at a time,
+            so the list for a big file is never made all at once.
+        """
+        findall = self.tokenrex.findall
+        length = len(text)
+        size = self.chunk_size
+        pos = 0
+        while pos < length:
+            end = pos + size
+            if end >= length:
+                yield findall(text, pos)
+                return
+            values = findall(text, pos, end)
+            if len(values) < 2:
+                # One token is bigger than the chunk.
+                size *= 2
+                continue
+            # The last token may be cut off at the end of the chunk, it is
+            # found again in the next one.
+            values.pop()
+            yield values
+            pos += sum(map(len, values))
+
+
+class FastRegexLexer(pygments.lexer.RegexLexer):
+    """ Base class for the RegexLexer() subclasses made by `fast_lexer()`.
+        The rules of each state are joined into one regex, so the rule that
+        matches is found with one call into `re`, instead of one call per
+        rule. Tokens are the same as the original lexer's.
+    """
+    # Inline flags for a whole regex, which are only allowed at the start.
+    flagsrex = re.compile(r'\(\?[aiLmsux]+\)')
+    # Backreferences and conditionals by group number would point to the
+    # wrong group in a joined regex, so those rules are used on their own.
+    unjoinablerex = re.compile(r'\\[1-9]|\(\?\(\d|\(\?[aiLmsux]+\)')
+    # Flags that can be set for part of a regex, with their letters.
+    scopedflags = (
+        (re.IGNORECASE, 'i'),
+        (re.MULTILINE, 'm'),
+        (re.DOTALL, 's'),
+        (re.VERBOSE, 'x'),
+    )
+    # States with fewer rules are not joined. The first few rules match
+    # most text, so a joined regex is no faster for them. INI and kernel
+    # logs have hand-written subclasses instead.
+    min_rules = 10
+    # Joined rules for each state, set on subclasses by `subclass()`:
+    #     {state: [(match, rules), ...]}
+    # Where `rules` is {group_index: rule} for a joined regex, or a single
+    # (rexmatch, action, new_state) rule for a regex of its own.
+    _fasttokens = None
+
+    def get_tokens_unprocessed(self, text, stack=('root',)):
+        """ Same as `RegexLexer.get_tokens_unprocessed()`. """
+        return self.get_tokens_states(text, stack=stack)
+
+    def get_tokens_states(self, text, pos=0, stack=('root',), states=None):
+        """ Same as `get_tokens_states()`, with the joined rules, except
+            that line states are only saved if `states` is a dict.
+        """
+        fasttokens = self._fasttokens
+        statestack = list(stack)
+        segments = fasttokens[statestack[-1]]
+        while True:
+            for match, rules in segments:
+                m = match(text, pos)
+                if m is not None:
+                    break
+            else:
+                # No rule matched.
+                try:
+                    char = text[pos]
+                except IndexError:
+                    break
+                if char == '\n':
+                    # At EOL, reset state to "root".
+                    statestack = ['root']
+                    segments = fasttokens['root']
+                    yield pos, token.Whitespace, '\n'
+                    pos += 1
+                    if states is not None:
+                        states[pos] = ('root',)
+                    continue
+                yield pos, token.Error, char
+                pos += 1
+                continue
+            if type(rules) is dict:
+                rexmatch, action, new_state = rules[m.lastindex]
+                if not (action is None or type(action) is token._TokenType):
+                    # Callbacks get the rule's own match, for its groups.
+                    m = rexmatch(text, pos)
+            else:
+                _, action, new_state = rules
+            if action is not None:
+                if type(action) is token._TokenType:
+                    yield pos, action, m.group()
+                else:
+                    yield from action(self, m)
+            pos = m.end()
+            if new_state is not None:
+                _change_state(statestack, new_state)
+                segments = fasttokens[statestack[-1]]
+            if (states is not None) and (text[pos - 1:pos] == '\n'):
+                states[pos] = tuple(statestack)
+        if states is not None:
+            states[len(text)] = tuple(statestack)
+
+    def _rule_tokens(self, text, pos, statestack, states=None, first=0):
+        """ Yield the tokens for the first of the lexer's own rules (from
+            `_tokens`, starting at index `first`) that matches at `pos`, or
+            for one unmatched character, like `get_tokens_states()`.
+            For hand-written subclasses, in the states they don't handle.
+            `statestack` (a list) is changed in place.
+            Returns the new position, or None at the end of text.
+        """
+        rules = self._tokens[statestack[-1]]
+        for rexmatch, action, new_state in rules[first:]:
+            m = rexmatch(text, pos)
+            if m is not None:
+                break
+        else:
+            # No rule matched.
+            try:
+                char = text[pos]
+            except IndexError:
+                return None
+            if char == '\n':
+                # At EOL, reset state to "root".
+                statestack[:] = ['root']
+                yield pos, token.Whitespace, '\n'
+                if states is not None:
+                    states[pos + 1] = ('root',)
+            else:
+                yield pos, token.Error, char
+            return pos + 1
+        if action is not None:
+            if type(action) is token._TokenType:
+                yield pos, action, m.group()
+            else:
+                yield from action(self, m)
+        pos = m.end()
+        if new_state is not None:
+            _change_state(statestack, new_state)
+        if (states is not None) and (text[pos - 1:pos] == '\n'):
+            states[pos] = tuple(statestack)
+        return pos
+
+    @classmethod
+    def join_rules(cls, rules):
+        """ Join a state's rules, [(rexmatch, action, new_state), ...], into
+            as few regexes as possible, in the same order.
+            Returns [(match, rules), ...], see `_fasttokens`.
+        """
+        segments = []
+        run = []
+        runflags = None
+        for rule in rules:
+            rex = rule[0].__self__
+            pattern = rex.pattern
+            leading = cls.flagsrex.match(pattern)
+            if leading is not None:
+                pattern = pattern[leading.end():]
+            if cls.unjoinablerex.search(pattern):
+                segments.extend(cls._join_run(run, runflags))
+                run = []
+                segments.append((rule[0], rule))
+                continue
+            # Flags that can't be scoped must be the same for the whole run.
+            flags = rex.flags & (re.ASCII | re.LOCALE)
+            if run and (flags != runflags):
+                segments.extend(cls._join_run(run, runflags))
+                run = []
+            runflags = flags
+            scoped = ''.join(
+                c for flag, c in cls.scopedflags if rex.flags & flag
+            )
+            if scoped:
+                # A verbose pattern may end in a comment.
+                pattern = '(?{}:{}{})'.format(
+                    scoped,
+                    pattern,
+                    '\n' if rex.flags & re.VERBOSE else '',
+                )
+            run.append((pattern, rex.groups, rule))
+        segments.extend(cls._join_run(run, runflags))
+        return segments
+
+    @classmethod
+    def subclass(cls, lexer):
+        """ Return a FastRegexLexer subclass for a RegexLexer(), or None if
+            its rules can't be used this way, or no state has enough rules
+            (`min_rules`) to be faster joined.
+        """
+        lexercls = type(lexer)
+        if not lexer_states_supported(lexer):
+            return None
+        if getattr(lexercls, 'token_variants', False):
+            # Rules are set for each instance, from its options.
+            return None
+        fasttokens = {}
+        joined = False
+        for state, rules in lexercls._tokens.items():
+            if len(rules) < cls.min_rules:
+                fasttokens[state] = [(rule[0], rule) for rule in rules]
+                continue
+            fasttokens[state] = cls.join_rules(rules)
+            joined = joined or (len(fasttokens[state]) < len(rules))
+        if not joined:
+            return None
+        return type(lexercls)(
+            lexercls.__name__,
+            (cls, lexercls),
+            {
+                # Same name and module as the original, which has the same
+                # tokens, so cache keys (`lexer_key`) are shared.
+                '__module__': lexercls.__module__,
+                '__doc__': lexercls.__doc__,
+                '_tokens': lexercls._tokens,
+                '_fasttokens': fasttokens,
+            },
+        )
 
-    usage = ''
+    @staticmethod
+    def _join_run(run, flags):
+        """ Join a run of (pattern, groups, rule) into one regex, returning
+            [(match, {group_index: rule})], or a segment for each rule if
+            they can't be joined.
+        """
+        if len(run) < 2:
+            return [(rule[0], rule) for _, _, rule in run]
+        patterns = []
+        rules = {}
+        index = 1
+        for pattern, groups, rule in run:
+            # The rule's own groups come after the one wrapped around it.
+            patterns.append('({})'.format(pattern))
+            rules[index] = rule
+            index += groups + 1
+        try:
+            rex = re.compile('|'.join(patterns), flags)
+        except (re.error, OverflowError, RecursionError):
+            # Duplicate group names, or too big.
+            return [(rule[0], rule) for _, _, rule in run]
+        return [(rex.match, rules)]
+
+
+class FastIniLexer(FastRegexLexer, IniLexer):
+    """ An IniLexer() that handles most lines without trying each rule in
+        turn. Whitespace, comments, sections, and `name = value` lines are
+        picked by their first character and the characters on the line,
+        and quoted values and line continuations use the IniLexer's own
+        rules. Tokens are the same as the IniLexer's.
+    """
+    # The IniLexer's root rules this was written for. `fast_lexer()` only
+    # uses this class when pygments has the same ones.
+    rootpatterns = (
+        r'\s+',
+        r'[;#].*',
+        r'(\[.*?\])([ \t]*)$',
+        r'''(.*?)([ \t]*)([=:])([ \t]*)(["'])''',
+        r'(.*?)([ \t]*)([=:])([ \t]*)([^;#\n]*)(\\)(\s+)',
+        r'(.*?)([ \t]*)([=:])([ \t]*)([^ ;#\n]*(?: +[^ ;#\n]+)*)',
+        r'(.+?)$',
+    )
+    # Token types for the groups of a `name = value` line.
+    valuetypes = (
+        token.Name.Attribute,
+        token.Whitespace,
+        token.Operator,
+        token.Whitespace,
+        token.String,
+    )
 
-    def __init__(self, message=''):
-        usagestr = '{}\n{}'.format(message,
-                                   _coloredhelp(self.usage)).strip()
-        SystemExit.__init__(self, usagestr)
+    def get_tokens_states(self, text, pos=0, stack=('root',), states=None):
+        """ Same as `FastRegexLexer.get_tokens_states()`. """
+        Whitespace = token.Whitespace
+        Attribute = token.Name.Attribute
+        tokendefs = self._tokens
+        root = tokendefs['root']
+        spacematch = root[0][0]
+        commentmatch = root[1][0]
+        sectionmatch = root[2][0]
+        valuematch = root[5][0]
+        valuetypes = tuple(enumerate(self.valuetypes, 1))
+        find = text.find
+        length = len(text)
+        statestack = list(stack)
+        while True:
+            # Index of the first rule that can match, for the other states.
+            first = 0
+            if len(statestack) == 1:
+                try:
+                    char = text[pos]
+                except IndexError:
+                    break
+                if char.isspace():
+                    m = spacematch(text, pos)
+                    yield pos, Whitespace, m.group()
+                    pos = m.end()
+                    if (states is not None) and (text[pos - 1] == '\n'):
+                        states[pos] = ('root',)
+                    continue
+                if (char == ';') or (char == '#'):
+                    m = commentmatch(text, pos)
+                    yield pos, token.Comment.Single, m.group()
+                    pos = m.end()
+                    continue
+                if char == '[':
+                    m = sectionmatch(text, pos)
+                    if m is not None:
+                        yield pos, token.Keyword, m.group(1)
+                        if m.group(2):
+                            yield m.start(2), Whitespace, m.group(2)
+                        pos = m.end()
+                        continue
+                eol = find('\n', pos)
+                if eol < 0:
+                    eol = length
+                if (find('"', pos, eol) >= 0) or (find("'", pos, eol) >= 0):
+                    first = 3
+                elif find('\\', pos, eol) >= 0:
+                    first = 4
+                elif (find('=', pos, eol) >= 0) or (find(':', pos, eol) >= 0):
+                    m = valuematch(text, pos)
+                    for i, ttype in valuetypes:
+                        value = m.group(i)
+                        if value:
+                            yield m.start(i), ttype, value
+                    pos = m.end()
+                    continue
+                else:
+                    yield pos, Attribute, text[pos:eol]
+                    pos = eol
+                    continue
+            pos = yield from self._rule_tokens(
+                text,
+                pos,
+                statestack,
+                states,
+                first=first,
+            )
+            if pos is None:
+                break
+        if states is not None:
+            states[len(text)] = tuple(statestack)
+
+
+class FastKernelLogLexer(FastRegexLexer, KernelLogLexer):
+    """ A KernelLogLexer() that finds the level of each line with one search
+        for its words, and splits lines with string methods, instead of
+        trying each rule in turn. Lines with a facility prefix use the
+        KernelLogLexer's own rules. Tokens are the same as the
+        KernelLogLexer's.
+    """
+    # The KernelLogLexer's rules this was written for, by state.
+    # `fast_lexer()` only uses this class when pygments has the same ones.
+    linepatterns = (
+        r'\[[0-9. ]+\] ',
+        r'(?<=\] ).+?:',
+        r'\n',
+        r'.+\n',
+    )
+    statepatterns = {
+        'unknown': (
+            r'^(?=.+(warning|notice|audit|deprecated))',
+            r'^(?=.+(error|critical|fail|Bug))',
+            '',
+        ),
+        'debug': linepatterns,
+        'info': linepatterns,
+        'warn': linepatterns,
+        'error': linepatterns,
+    }
+    # Words that make a line a warning, or an error, after its first
+    # character.
+    warnrex = re.compile('warning|notice|audit|deprecated')
+    errorrex = re.compile('error|critical|fail|Bug')
+
+    def get_tokens_states(self, text, pos=0, stack=('root',), states=None):
+        """ Same as `FastRegexLexer.get_tokens_states()`. """
+        Text = token.Text
+        tokendefs = self._tokens
+        numbermatch = tokendefs['info'][0][0]
+        # Token type for the rest of a line, by state.
+        linetypes = {
+            state: tokendefs[state][3][1]
+            for state in ('debug', 'info', 'warn', 'error')
+        }
+        warnsearch = self.warnrex.search
+        errorsearch = self.errorrex.search
+        find = text.find
+        length = len(text)
+        statestack = list(stack)
+        while True:
+            state = statestack[-1]
+            if state == 'unknown':
+                linestart = (pos == 0) or (text[pos - 1] == '\n')
+                state = 'info'
+                if linestart:
+                    eol = find('\n', pos)
+                    if eol < 0:
+                        eol = length
+                    if warnsearch(text, pos + 1, eol) is not None:
+                        state = 'warn'
+                    elif errorsearch(text, pos + 1, eol) is not None:
+                        state = 'error'
+                    if state != 'info':
+                        yield pos, Text, ''
+                statestack.append(state)
+                if linestart and pos and (states is not None):
+                    # Like the lexer's rules, the state after an empty
+                    # match at the start of a line is saved for it.
+                    states[pos] = tuple(statestack)
+                continue
+            linetype = linetypes.get(state, None)
+            if linetype is not None:
+                try:
+                    char = text[pos]
+                except IndexError:
+                    break
+                if char == '[':
+                    m = numbermatch(text, pos)
+                    if m is not None:
+                        yield pos, token.Number, m.group()
+                        pos = m.end()
+                        continue
+                eol = find('\n', pos)
+                if eol == pos:
+                    yield pos, Text, '\n'
+                elif eol < 0:
+                    # No newline at the end, see the lexer's own rules.
+                    linetype = None
+                elif text[pos - 2:pos] == '] ':
+                    colon = find(':', pos + 1, eol)
+                    if colon >= 0:
+                        yield pos, token.Keyword, text[pos:colon + 1]
+                        pos = colon + 1
+                        continue
+                    yield pos, linetype, text[pos:eol + 1]
+                else:
+                    yield pos, linetype, text[pos:eol + 1]
+                if linetype is not None:
+                    pos = eol + 1
+                    if len(statestack) > 1:
+                        statestack.pop()
+                    if states is not None:
+                        states[pos] = tuple(statestack)
+                    continue
+            pos = yield from self._rule_tokens(text, pos, statestack, states)
+            if pos is None:
+                break
+        if states is not None:
+            states[len(text)] = tuple(statestack)
+
+
+class LexDeadline(object):
+    """ A per-file time budget for lexing, used as a context manager.
+        Only the time between `start()` and `stop()` is counted, so time
+        spent by the code consuming the tokens (formatting, or writing to a
+        slow terminal) doesn't use up the budget. `check()` raises
+        LexTimeout once the budget is spent.
+        In the main thread a SIGALRM timer is also armed with the rest of
+        the budget while lexing, because a single regex match can backtrack
+        for minutes (the `re` module checks for signals while matching).
+        The timer only raises while `lexing` is set.
+        Deadlines can be open at the same time, from token generators that
+        are interleaved or nested, and exit in any order. They share one
+        timer, armed for the earliest deadline that is lexing. A timer that
+        was already set is paused while any of them are open, and restored
+        when the last one exits.
+    """
+    # Open deadlines that use the timer, in the order they were entered.
+    _open = []
+    # Handler and timer from before the first open deadline.
+    _oldhandler = None
+    _oldtimer = (0, 0)
+    _entered = None
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.remaining = seconds
+        self.expired = False
+        self.lexing = False
+        self._started = None
+        self._use_alarm = (
+            hasattr(signal, 'setitimer') and
+            (threading.current_thread() is threading.main_thread())
+        )
 
+    def __enter__(self):
+        self.remaining = self.seconds
+        self.expired = False
+        if self._use_alarm:
+            cls = LexDeadline
+            if not cls._open:
+                cls._entered = time.monotonic()
+                cls._oldtimer = signal.setitimer(signal.ITIMER_REAL, 0)
+                cls._oldhandler = signal.signal(
+                    signal.SIGALRM,
+                    cls._on_alarm,
+                )
+            cls._open.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self._use_alarm:
+            self.lexing = False
+            cls = LexDeadline
+            if self in cls._open:
+                cls._open.remove(self)
+            if cls._open:
+                cls._arm()
+                return False
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            oldhandler = cls._oldhandler
+            if oldhandler is None:
+                # Previous handler was not installed from Python.
+                oldhandler = signal.SIG_DFL
+            signal.signal(signal.SIGALRM, oldhandler)
+            delay, interval = cls._oldtimer
+            if delay:
+                # The old timer keeps counting down from when it was paused.
+                delay -= time.monotonic() - cls._entered
+                signal.setitimer(
+                    signal.ITIMER_REAL,
+                    max(delay, 1e-6),
+                    interval,
+                )
+            cls._oldhandler = None
+            cls._oldtimer = (0, 0)
+        return False
 
-def _coloredhelp(s):
-    """ Colorize the usage string for docopt
+    @classmethod
+    def _arm(cls):
+        """ Arm the timer for the earliest open deadline that is lexing and
+            not expired yet, or disarm it if there are none.
+        """
+        dues = [
+            deadline._started + deadline.remaining
+            for deadline in cls._open
+            if deadline.lexing and not deadline.expired
+        ]
+        if not dues:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            return
+        delay = min(dues) - time.monotonic()
+        signal.setitimer(signal.ITIMER_REAL, max(delay, 1e-6))
+
+    @classmethod
+    def _on_alarm(cls, signum, frame):
+        """ Mark the lexing deadlines that are due as expired, and raise
+            LexTimeout if the last one started is one of them. The others
+            raise from `check()` when they get to run again.
+        """
+        now = time.monotonic()
+        lexing = [deadline for deadline in cls._open if deadline.lexing]
+        for deadline in lexing:
+            if deadline._started + deadline.remaining <= now:
+                deadline.expired = True
+        cls._arm()
+        if lexing:
+            current = max(lexing, key=lambda deadline: deadline._started)
+            if current.expired:
+                raise LexTimeout()
+
+    def check(self):
+        """ Raise LexTimeout if the budget is spent. """
+        spent = (time.monotonic() - self._started) if self.lexing else 0
+        if self.expired or (spent >= self.remaining):
+            self.expired = True
+            raise LexTimeout()
+
+    def start(self):
+        """ Start counting lexing time against the budget. """
+        self._started = time.monotonic()
+        self.lexing = True
+        if self._use_alarm:
+            LexDeadline._arm()
+
+    def stop(self):
+        """ Stop counting lexing time, until the next `start()`. """
+        self.lexing = False
+        if self._use_alarm:
+            LexDeadline._arm()
+        self.remaining -= time.monotonic() - self._started
+
+
+class LexRecord(object):
+    """ Tokens and lexer states from rendering one file, so the next render
+        only has to lex the changed lines (see `Printer(incremental=True)`).
+        Lines are split on '\n' only, because lexer states are only saved
+        after newlines. Token values are stored as end offsets into `text`.
+    """
+    # Header for a serialized record: magic, metadata length, text length,
+    # and token count.
+    header = struct.Struct('<4sIII')
+    magic = b'CCL2'
+
+    def __init__(self, key, text):
+        """ Initialize an empty record for preprocessed text.
+            Arguments:
+                key  : Lexer key, from `lexer_key()`.
+                text : Preprocessed content, from `lexer_input()`.
+        """
+        self.key = key
+        self.text = text
+        lines = text.split('\n')
+        self.hashes = [hash(line) for line in lines]
+        # Start offset for each line.
+        self.offsets = array.array('I', itertools.accumulate(
+            itertools.chain((0, ), (len(line) + 1 for line in lines[:-1]))
+        ))
+        # Lexer state stack and first token index, by line number,
+        # for lines that start on a token boundary.
+        self.states = {}
+        # Interned token types.
+        self.ttypes = []
+        self.typeids = {}
+        # Token type ids and end offsets.
+        self.types = array.array('H')
+        self.ends = array.array('I')
+
+    def __repr__(self):
+        return '{}(lines={}, tokens={}, states={})'.format(
+            type(self).__name__,
+            len(self.hashes),
+            len(self.types),
+            len(self.states),
+        )
+
+    def add_token(self, ttype, end):
+        """ Add a token, by type and end offset.
+            Returns False if there are too many token types to store it.
+        """
+        typeid = self.typeids.get(ttype, None)
+        if typeid is None:
+            if len(self.ttypes) > 0xffff:
+                return False
+            typeid = self.typeids[ttype] = len(self.ttypes)
+            self.ttypes.append(ttype)
+        self.types.append(typeid)
+        self.ends.append(end)
+        return True
+
+    @staticmethod
+    def cache_key(path):
+        """ Return a TokenCache key for a file's saved record. """
+        return hashlib.sha1(
+            'LexRecord\0{}'.format(path).encode('utf-8', 'surrogatepass')
+        ).hexdigest()
+
+    def copy_prefix(self, old, line):
+        """ Copy tokens and states from an `old` record, for all lines
+            before `line`. The lines must be the same in both records.
+        """
+        _, tokenindex = old.states[line]
+        self.ttypes = list(old.ttypes)
+        self.typeids = dict(old.typeids)
+        self.types = old.types[:tokenindex]
+        self.ends = old.ends[:tokenindex]
+        self.states = {
+            oldline: state
+            for oldline, state in old.states.items()
+            if oldline <= line
+        }
+
+    def copy_suffix(self, old, line, oldline):
+        """ Copy tokens and states from an `old` record, for all lines
+            starting at `line` (`oldline` in the old record), and yield the
+            copied (tokentype, value) tokens.
+            The rest of the lines must be the same in both records, and
+            `copy_prefix` must have been used first (for token type ids).
+        """
+        _, oldtokenindex = old.states[oldline]
+        linedelta = line - oldline
+        tokendelta = len(self.types) - oldtokenindex
+        for stateline, (stack, tokenindex) in old.states.items():
+            if stateline >= oldline:
+                self.states[stateline + linedelta] = (
+                    stack,
+                    tokenindex + tokendelta
+                )
+        shift = self.offsets[line] - old.offsets[oldline]
+        self.types.extend(old.types[oldtokenindex:])
+        self.ends.extend(end + shift for end in old.ends[oldtokenindex:])
+        yield from old.iter_tokens(start=oldtokenindex)
+
+    def diff(self, old):
+        """ Compare lines with an `old` record.
+            Returns (first changed line, first line of the unchanged end),
+            as line numbers in this record.
+        """
+        new, prev = self.hashes, old.hashes
+        changed = _common_prefix(new, prev)
+        end = (
+            self.offsets[changed] if changed < len(new) else len(self.text)
+        )
+        if self.text[:end] != old.text[:end]:
+            # Hash collision.
+            return 0, len(new)
+        if changed == len(new) == len(prev):
+            return changed, changed
+        # The unchanged end can't overlap the changed line.
+        limit = min(len(new), len(prev)) - changed
+        unchanged = _common_prefix(new[::-1][:limit], prev[::-1][:limit])
+        suffixstart = len(new) - unchanged
+        oldstart = len(prev) - unchanged
+        if unchanged and (
+                self.text[self.offsets[suffixstart]:] !=
+                old.text[old.offsets[oldstart]:]):
+            # Hash collision.
+            return changed, len(new)
+        return changed, suffixstart
+
+    @classmethod
+    def from_bytes(cls, blob):
+        """ Load a record serialized with `to_bytes`.
+            Raises ValueError for bad records.
+        """
+        try:
+            magic, metalen, textlen, ntokens = cls.header.unpack_from(blob)
+        except struct.error as ex:
+            raise ValueError('Bad lex record: {}'.format(ex)) from ex
+        if magic != cls.magic:
+            raise ValueError('Bad lex record: {!r}'.format(magic))
+        start = cls.header.size
+        meta = json.loads(blob[start:start + metalen].decode('utf-8'))
+        start += metalen
+        text = blob[start:start + textlen].decode('utf-8', 'surrogatepass')
+        start += textlen
+        try:
+            record = cls(meta['key'], text)
+            record.ttypes = [
+                token.string_to_tokentype(name) for name in meta['ttypes']
+            ]
+            record.states = {
+                line: (tuple(stack), tokenindex)
+                for line, stack, tokenindex in meta['states']
+            }
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            # Valid JSON, but not a record's metadata.
+            raise ValueError('Bad lex record: {!r}'.format(ex)) from ex
+        record.typeids = {ttype: i for i, ttype in enumerate(record.ttypes)}
+        size = ntokens * record.types.itemsize
+        record.types.frombytes(blob[start:start + size])
+        start += size
+        size = ntokens * record.ends.itemsize
+        record.ends.frombytes(blob[start:start + size])
+        if sys.byteorder == 'big':
+            record.types.byteswap()
+            record.ends.byteswap()
+        if (
+                (len(record.types) != ntokens) or
+                (len(record.ends) != ntokens) or
+                (ntokens and (record.ends[-1] != len(text)))):
+            raise ValueError('Bad lex record, wrong size.')
+        if ntokens and (max(record.types) >= len(record.ttypes)):
+            raise ValueError('Bad lex record, unknown token type.')
+        return record
+
+    def iter_tokens(self, start=0, stop=None):
+        """ Yield (tokentype, value) for a range of token indexes. """
+        ttypes = self.ttypes
+        text = self.text
+        pos = self.ends[start - 1] if start else 0
+        types = self.types[start:stop]
+        ends = self.ends[start:stop]
+        for typeid, end in zip(types, ends):
+            yield ttypes[typeid], text[pos:end]
+            pos = end
+
+    def resume_line(self, line):
+        """ Return the closest line at or before `line` with a saved state.
+        """
+        while (line > 0) and (line not in self.states):
+            line -= 1
+        return max(line, 0)
+
+    def to_bytes(self):
+        """ Serialize this record. Line hashes are not saved, they are
+            rebuilt when it is loaded.
+        """
+        meta = json.dumps({
+            'key': self.key,
+            'ttypes': ['.'.join(ttype) for ttype in self.ttypes],
+            'states': [
+                [line, stack, tokenindex]
+                for line, (stack, tokenindex) in self.states.items()
+            ],
+        }).encode('utf-8')
+        text = self.text.encode('utf-8', 'surrogatepass')
+        types, ends = self.types, self.ends
+        if sys.byteorder == 'big':
+            types, ends = array.array('H', types), array.array('I', ends)
+            types.byteswap()
+            ends.byteswap()
+        return b''.join((
+            self.header.pack(self.magic, len(meta), len(text), len(types)),
+            meta,
+            text,
+            types.tobytes(),
+            ends.tobytes(),
+        ))
+
+
+class Metrics(object):
+    """ Counters and histograms collected over a run (files, sizes, how
+        lexers were picked, lexing time by lexer, fallbacks, errors), for
+        batch jobs. They can be saved as JSON or Prometheus text.
+        Thread-safe.
+    """
+    # Upper bounds of histogram buckets, by histogram name.
+    buckets = {
+        'file_chars': (1e3, 1e4, 1e5, 1e6, 1e7),
+        'file_lex_seconds': (0.001, 0.01, 0.1, 1, 10),
+    }
+    # Prefix for Prometheus metric names.
+    prefix = 'ccat_'
+
+    def __init__(self):
+        # {name: {sorted_label_items: value}}
+        self._counters = OrderedDict()
+        # {name: {'buckets': [count per bucket], 'count': n, 'sum': n}},
+        # with a last bucket for values over the largest bound.
+        self._histograms = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '{}(counters={}, histograms={})'.format(
+            type(self).__name__,
+            len(self._counters),
+            len(self._histograms),
+        )
+
+    def as_dict(self):
+        """ Return all metrics as a JSON-friendly dict, with a summary of
+            files, input size, and lexing time (chars per second) by lexer.
+        """
+        with self._lock:
+            counters = {
+                name: [
+                    {'labels': dict(labels), 'value': value}
+                    for labels, value in values.items()
+                ]
+                for name, values in self._counters.items()
+            }
+            histograms = {
+                name: {
+                    'buckets': list(zip(
+                        self._bucket_labels(name),
+                        itertools.accumulate(hist['buckets']),
+                    )),
+                    'count': hist['count'],
+                    'sum': hist['sum'],
+                }
+                for name, hist in self._histograms.items()
+            }
+        lexerstats = {}
+        for name, key in (
+                ('files', 'files'),
+                ('input_chars', 'input_chars'),
+                ('lex_seconds', 'lex_seconds')):
+            for item in counters.get(name, ()):
+                lexername = item['labels'].get('lexer', None)
+                if lexername is None:
+                    continue
+                lexerstats.setdefault(lexername, {})[key] = item['value']
+        for stats in lexerstats.values():
+            seconds = stats.get('lex_seconds', 0)
+            stats['chars_per_second'] = round(
+                stats.get('input_chars', 0) / seconds
+            ) if seconds else None
+        return {
+            'counters': counters,
+            'histograms': histograms,
+            'lexers': lexerstats,
+        }
+
+    def as_prometheus(self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        with self._lock:
+            for name, values in self._counters.items():
+                fullname = '{}{}_total'.format(self.prefix, name)
+                lines.append('# TYPE {} counter'.format(fullname))
+                lines.extend(
+                    '{}{} {}'.format(fullname, self._labelstr(labels), value)
+                    for labels, value in values.items()
+                )
+            for name, hist in self._histograms.items():
+                fullname = '{}{}'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(fullname))
+                cumulative = itertools.accumulate(hist['buckets'])
+                for le, value in zip(self._bucket_labels(name), cumulative):
+                    lines.append('{}_bucket{} {}'.format(
+                        fullname,
+                        self._labelstr((('le', le),)),
+                        value,
+                    ))
+                lines.append('{}_sum {}'.format(fullname, hist['sum']))
+                lines.append('{}_count {}'.format(fullname, hist['count']))
+        return '{}\n'.format('\n'.join(lines))
+
+    def count(self, name, value=1, **labels):
+        """ Add `value` to a counter, with optional labels. """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, OrderedDict())
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name, value):
+        """ Add a value to a histogram from `buckets`. """
+        bounds = self.buckets[name]
+        with self._lock:
+            hist = self._histograms.get(name, None)
+            if hist is None:
+                hist = self._histograms[name] = {
+                    'buckets': [0] * (len(bounds) + 1),
+                    'count': 0,
+                    'sum': 0,
+                }
+            hist['buckets'][bisect.bisect_left(bounds, value)] += 1
+            hist['count'] += 1
+            hist['sum'] += value
+
+    def save(self, path):
+        """ Write all metrics to a file, as Prometheus text if the name ends
+            with '.prom', otherwise as JSON. The file is replaced atomically,
+            so readers never see a partial file.
+            Raises EnvironmentError on failure.
+        """
+        if path.endswith('.prom'):
+            data = self.as_prometheus()
+        else:
+            data = json.dumps(self.as_dict(), indent=4, sort_keys=True)
+        tmppath = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmppath, 'w') as f:
+                f.write(data)
+            os.replace(tmppath, path)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+
+    def _bucket_labels(self, name):
+        """ Return the 'le' labels for a histogram's buckets. """
+        return [
+            '{:g}'.format(bound) for bound in self.buckets[name]
+        ] + ['+Inf']
+
+    @staticmethod
+    def _labelstr(labels):
+        """ Format (name, value) label items for Prometheus. """
+        if not labels:
+            return ''
+        return '{{{}}}'.format(','.join(
+            '{}="{}"'.format(
+                name,
+                str(value).replace('\\', '\\\\').replace(
+                    '"', '\\"'
+                ).replace('\n', '\\n'),
+            )
+            for name, value in labels
+        ))
+
+
+class Printer(object):
+    """ Renders files with a resolved Formatter() and options.
+        All per-run state lives on the instance (no module globals), and
+        the lexer caches are guarded by a lock, so one Printer can be
+        shared between threads and keep its caches warm across renders.
+    """
+    # Maximum number of file names to remember lexers for.
+    lexer_cache_size = 4096
+    # Maximum number of files to keep a LexRecord() in memory for.
+    record_cache_size = 64
+    # Terminal output is formatted in windows of about this many
+    # characters, instead of all at once (see `format_windows`).
+    window_size = 65536
+    # Bytes to decode from a memory map (or read from a pipe) at a time.
+    map_chunk_size = 1024 * 1024
+
+    def __init__(
+            self, formatter=None, lexer=None, guess=False, ext_lexers=None,
+            linenos=False, nocolors=False, printnames=False, debug=False,
+            encoding=None, errors=None, time_budget=None, token_cache=None,
+            incremental=False, grep=None, context=0, metrics=None,
+            fast=False, lines=None, record_cache=None):
+        """ Initialize a Printer.
+            Arguments:
+                formatter  : A pygments Formatter(), pre-initialized.
+                             Required unless `nocolors` is set.
+                lexer      : User's lexer name, used for all files.
+                guess      : Always guess the lexer by content.
+                ext_lexers : Dict of {file_ext: lexer_name}.
+                linenos    : Print line numbers.
+                nocolors   : Pipe content without using pygments.
+                printnames : Print a file name header before each file.
+                debug      : Print debug info.
+                encoding   : Output encoding. Default: sys.stdout's.
+                errors     : Output encoding error handler.
+                time_budget: Maximum seconds to spend lexing each file.
+                             The rest of the file is rendered as plain text
+                             when it runs out. See `fallbacks`.
+                token_cache: A TokenCache() to reuse lexed tokens from.
+                             It can be shared with other Printers.
+                incremental: Keep a LexRecord() for each file name, so
+                             only the changed lines are lexed when a file
+                             is rendered again. Only used for lexers where
+                             `lexer_resumable()` is True, others are lexed
+                             whole.
+                grep       : A compiled regex pattern. Only matching lines
+                             are rendered, with line numbers.
+                context    : Lines of context to render around `grep`
+                             matches.
+                metrics    : A Metrics() to count files, sizes, lexers,
+                             lexing time, and errors in.
+                fast       : Use a `fast_lexer()` when there is one.
+                lines      : (first, last) line numbers to render, from
+                             1, where `last` is None for the end of the
+                             file. Files are rendered in batches with
+                             `stream_iter` when the lexer allows it (see
+                             `_lines_batched()`), otherwise the whole file
+                             is lexed.
+                record_cache: A TokenCache() to save LexRecords in, from
+                              `incremental`, so later runs can use them.
+                              It is separate from `token_cache`, which
+                              isn't needed for `incremental`.
+        """
+        if not (formatter or nocolors):
+            raise ValueError('Need a formatter to use.')
+        self.formatter = formatter
+        self.lexername = lexer
+        self.guess = guess
+        self.ext_lexers = ext_lexers or {}
+        self.linenos = linenos
+        self.nocolors = nocolors
+        self.printnames = printnames
+        self.debug = debug
+        self.encoding = (
+            encoding or getattr(sys.stdout, 'encoding', None) or 'utf-8'
+        )
+        self.errors = errors or getattr(sys.stdout, 'errors', None) or 'strict'
+        self.time_budget = time_budget
+        self.token_cache = token_cache
+        self.incremental = incremental
+        self.record_cache = record_cache
+        self.grep = grep
+        self.context = context
+        self.metrics = metrics
+        self.fast = fast
+        self.lines = lines
+        # Guards the caches below.
+        self._lock = threading.Lock()
+        # Lexer() instances, by file name (None for stdin).
+        self._lexers = OrderedDict()
+        # Shared Lexer() instances, by class.
+        self._lexer_instances = {}
+        # Files that fell back to plain text, from `time_budget`.
+        self._fallbacks = []
+        # LexRecord() for each file, by absolute path, from `incremental`.
+        self._records = OrderedDict()
+
+    def __repr__(self):
+        return '{}(formatter={!r}, lexer={!r}, linenos={!r})'.format(
+            type(self).__name__,
+            self.formatter,
+            self.lexername,
+            self.linenos,
+        )
+
+    def count(self, name, value=1, **labels):
+        """ Add to a counter in `metrics`, if it is set. """
+        if self.metrics is not None:
+            self.metrics.count(name, value, **labels)
+
+    def encode(self, s):
+        """ Encode a str for output. """
+        return s.encode(self.encoding, self.errors)
+
+    @property
+    def fallbacks(self):
+        """ A list of files that ran out of `time_budget`, as dicts of:
+                {'name': file name, 'lexer': lexer name, 'line': line number}
+            Where `line` is the first line printed as plain text.
+        """
+        with self._lock:
+            return list(self._fallbacks)
+
+    def format_iter(self, tokens, formatter=None, linenos=None):
+        """ Format (tokentype, value) tokens, yielding encoded lines.
+            Arguments:
+                tokens    : Tokens from `lex()`.
+                formatter : Formatter() to use, instead of `formatter`.
+                linenos   : Whether to print line numbers, instead of
+                            `linenos`.
+        """
+        formatter = formatter or self.formatter
+        linenos = self.linenos if linenos is None else linenos
+        hilitelines = pygments.format(tokens, formatter).splitlines()
+        # An extra newline that 'cat' doesn't print.
+        if hilitelines and not hilitelines[-1]:
+            hilitelines.pop(-1)
+
+        # Fix line number style for certain formatter styles.
+        if isinstance(formatter, formatters.HtmlFormatter):
+            # FIXME: Hack linenos style to match the main style.
+            hilitelines.append(
+                '<style>td.linenos { background-color: transparent; }</style>')
+
+        # Set up the line formatter also.
+        formatline = get_line_formatter(len(hilitelines), linenos=linenos)
+        for i, line in enumerate(hilitelines):
+            yield self.encode('{}\n'.format(formatline(i + 1, line)))
+
+    def format_windows(self, tokens, lines, formatter=None, linenos=None):
+        """ Format (tokentype, value) tokens in windows of about
+            `window_size` characters, yielding encoded chunks. The output
+            is the same as `format_iter()`, but the formatted text is never
+            held all at once, so memory use and the time before output
+            starts are bounded by the window size, not the file size (or
+            the line length, for minified files that are one huge line).
+            Only for terminal formatters.
+            Arguments:
+                tokens    : Tokens from `lex()`.
+                lines     : Number of lines, for the line number width
+                            (see `line_count()`).
+                formatter : Formatter() to use, instead of `formatter`.
+                linenos   : Whether to print line numbers, instead of
+                            `linenos`.
+        """
+        formatter = formatter or self.formatter
+        linenos = self.linenos if linenos is None else linenos
+        formatline = get_line_formatter(lines, linenos=linenos)
+        lineno = 1
+        linestart = True
+        # An empty last line isn't printed, so an empty line waits for
+        # something to follow it.
+        blank = False
+        window = []
+        size = 0
+        for tok in itertools.chain(tokens, (None,)):
+            if tok is not None:
+                window.append(tok)
+                size += len(tok[1])
+                if size < self.window_size:
+                    continue
+            if not window:
+                break
+            hilite = pygments.format(window, formatter)
+            window = []
+            size = 0
+            # Split like format_iter(), with an empty last part when the
+            # text ends with a line break.
+            parts = hilite.splitlines()
+            if hilite and (hilite[-1] in LINE_BREAKS):
+                parts.append('')
+            last = len(parts) - 1
+            out = []
+            for i, part in enumerate(parts):
+                if linestart:
+                    if not part:
+                        if i == last:
+                            # Nothing after the line break, yet.
+                            break
+                        if blank:
+                            out.append('{}\n'.format(formatline(lineno, '')))
+                            lineno += 1
+                        blank = True
+                        continue
+                    if blank:
+                        out.append('{}\n'.format(formatline(lineno, '')))
+                        lineno += 1
+                        blank = False
+                    # The line number goes before a line's first piece.
+                    out.append(formatline(lineno, ''))
+                    linestart = False
+                out.append(part)
+                if i < last:
+                    out.append('\n')
+                    linestart = True
+                    lineno += 1
+            if out:
+                yield self.encode(''.join(out))
+        if not linestart:
+            yield self.encode('\n')
+
+    def format_filename(self, filename):
+        """ Format a file name header for output. """
+        if self.nocolors:
+            return '\n{}:'.format(filename)
+        return '\n{}:'.format(color(filename, fore='blue'))
+
+    def lex(self, content, lexer, name=None):
+        """ Lex content with a Lexer(), returning a (tokentype, value) stream.
+            When `token_cache` is set, cached tokens are reused for content
+            that was lexed before (with any formatter or style).
+            When `incremental` is set, only changed lines are lexed for
+            files that were rendered before.
+            When `time_budget` is set, lexing is stopped when it runs out,
+            and the rest of the content is yielded as plain text.
+        """
+        uncached = (self.token_cache is None) and (not self.incremental)
+        if uncached and (not self.time_budget):
+            stream = lexer.get_tokens(content)
+        else:
+            stream = self._lex_text(lexer_input(lexer, content), lexer, name)
+            if lexer.filters:
+                stream = pygments.filter.apply_filters(
+                    stream,
+                    lexer.filters,
+                    lexer,
+                )
+        if self.metrics is not None:
+            stream = self._lex_timed(stream, lexer)
+        return stream
+
+    def _lex_timed(self, tokens, lexer, perfile=True):
+        """ Pass tokens through, adding the time spent lexing them to
+            `metrics`. The file's total is also added to the per-file
+            histogram when `perfile` is True.
+        """
+        clock = time.perf_counter
+        seconds = 0.0
+        try:
+            while True:
+                start = clock()
+                try:
+                    tok = next(tokens)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    seconds += clock() - start
+                yield tok
+        finally:
+            self.metrics.count('lex_seconds', seconds, lexer=lexer.name)
+            if perfile:
+                self.metrics.observe('file_lex_seconds', seconds)
+
+    def _lex_text(self, text, lexer, name):
+        """ Lex preprocessed text, using `token_cache`, `incremental`, and
+            `time_budget`.
+        """
+        cache = self.token_cache
+        if cache is not None:
+            key = cache.key(text, lexer)
+            cached = cache.get(key, text)
+            if cached is not None:
+                self.print_debug('Using cached tokens', lexer.name)
+                yield from cached
+                return
+
+        if self.incremental and name and lexer_resumable(lexer):
+            tokens = self._lex_incremental(text, lexer, name)
+        else:
+            tokens = lexer.get_tokens_unprocessed(text)
+            if self.time_budget:
+                tokens = self._lex_budget(tokens)
+            tokens = _drop_index(tokens)
+        if cache is not None:
+            tokens = cache.record(key, text, tokens)
+        pos = yield from tokens
+        if pos is None:
+            return
+        # Time budget was exceeded.
+        fallback = {
+            'name': name or 'stdin',
+            'lexer': lexer.name,
+            'line': text.count('\n', 0, pos) + 1,
+        }
+        self.print_debug('Time budget exceeded', fallback)
+        self.count('fallbacks', lexer=lexer.name)
+        with self._lock:
+            self._fallbacks.append(fallback)
+        yield token.Text, text[pos:]
+
+    def _lex_budget(self, tokens, pos=0):
+        """ Pass (index, tokentype, value) tokens through, stopping when
+            `time_budget` runs out. Only the time spent getting tokens
+            counts, not the time spent by the consumer between them.
+            Returns the offset lexing stopped at, or None if it finished.
+        """
+        done = expired = False
+        with LexDeadline(self.time_budget) as deadline:
+            while not (done or expired):
+                # Tokens are taken in batches, so the timer isn't re-armed
+                # for every token.
+                batch = []
+                deadline.start()
+                try:
+                    while len(batch) < 256:
+                        deadline.check()
+                        batch.append(next(tokens))
+                except StopIteration:
+                    done = True
+                except LexTimeout:
+                    expired = True
+                finally:
+                    deadline.stop()
+                for index, ttype, value in batch:
+                    pos = index + len(value)
+                    yield index, ttype, value
+                expired = expired or (deadline.remaining <= 0)
+        return None if done else pos
+
+    def _lex_incremental(self, text, lexer, name):
+        """ Lex preprocessed text, reusing tokens from the last time this
+            file was rendered. Lexing resumes from the saved lexer state
+            before the first changed line, and stops when the lexer state
+            and the rest of the content line up with the last render again.
+            Yields (tokentype, value), and returns the offset lexing stopped
+            at if `time_budget` ran out.
+        """
+        recordkey = lexer_key(lexer)
+        new = LexRecord(recordkey, text)
+        old = self._get_record(name)
+        if (old is not None) and (old.key != recordkey):
+            old = None
+        startline = 0
+        stack = ('root',)
+        # First changed line, and start of the unchanged lines at the end.
+        changed = suffixstart = len(new.hashes)
+        if old is not None:
+            changed, suffixstart = new.diff(old)
+            if changed == len(new.hashes) == len(old.hashes):
+                self.print_debug('Unchanged since last render', name)
+                self._set_record(name, old, save=False)
+                yield from old.iter_tokens()
+                return None
+            # Resume before the changed line, in case a regex looked ahead.
+            startline = old.resume_line(changed - 1)
+            stack, tokenindex = old.states[startline]
+            new.copy_prefix(old, startline)
+            yield from old.iter_tokens(stop=tokenindex)
+            self.print_debug(
+                'Incremental lex from line',
+                '{} (changed: {})'.format(startline + 1, changed + 1),
+            )
+        else:
+            new.states[0] = (stack, 0)
+
+        pos = seen = new.offsets[startline]
+        states = {}
+        tokens = get_tokens_states(lexer, text, pos, stack, states)
+        if self.time_budget:
+            tokens = self._lex_budget(tokens, pos=pos)
+        linedelta = len(new.hashes) - len(old.hashes) if old else 0
+        end = pos
+        exact = True
+        while True:
+            try:
+                index, ttype, value = next(tokens)
+            except StopIteration as stop:
+                if stop.value is not None:
+                    # Time budget was exceeded, don't save a partial record.
+                    return stop.value
+                break
+            stack = states.get(index, None)
+            if (stack is not None) and (index > seen):
+                # First token of a line, with a known lexer state.
+                seen = index
+                line = bisect.bisect_left(new.offsets, index)
+                new.states[line] = (stack, len(new.types))
+                if (line > changed) and (line >= suffixstart):
+                    oldstate = old.states.get(line - linedelta, None)
+                    if (oldstate is not None) and (oldstate[0] == stack):
+                        self.print_debug(
+                            'Incremental lex stopped at line',
+                            line + 1,
+                        )
+                        yield from new.copy_suffix(
+                            old,
+                            line,
+                            line - linedelta,
+                        )
+                        break
+            if index != end:
+                # Tokens don't cover the text exactly (some callbacks drop
+                # text, or use their own offsets).
+                exact = False
+            end = index + len(value)
+            exact = new.add_token(ttype, end) and exact
+            yield ttype, value
+        if exact:
+            self._set_record(name, new)
+        else:
+            self.print_debug('Not saving inexact lex record', name)
+        return None
+
+    def lexer_for(self, filename=None):
+        """ Return a cached Lexer() for a file name, or None if the lexer
+            should be guessed from the content.
+            Raises InvalidLexer if the user's lexer name is bad, and it
+            can't be resolved by file name.
+        """
+        return self._lexer_source(filename)[0]
+
+    def _lexer_source(self, filename):
+        """ Return a cached (Lexer(), source) for a file name, where
+            `source` says how the lexer was picked, for `metrics`:
+                'lexer'       : The user's lexer name.
+                'ext_lexers'  : The user's extension config.
+                'default_ext' : DEFAULT_EXT_LEXERS.
+                'filename'    : Pygments, by file name.
+                'guess'       : No lexer, it is guessed from the content.
+        """
+        if self.guess:
+            # Forced guess from the user.
+            return None, 'guess'
+        key = None if filename_is_stdin(filename) else (
+            os.path.basename(filename)
+        )
+        with self._lock:
+            try:
+                lexer, source = self._lexers[key]
+            except KeyError:
+                pass
+            else:
+                self._lexers.move_to_end(key)
+                return lexer, source
+
+        lexer, source = self._resolve_lexer(filename)
+        with self._lock:
+            if lexer is not None:
+                # Share Lexer() instances between file names.
+                lexer = self._lexer_instances.setdefault(type(lexer), lexer)
+            self._lexers[key] = lexer, source
+            if len(self._lexers) > self.lexer_cache_size:
+                self._lexers.popitem(last=False)
+        return lexer, source
+
+    def _resolve_lexer(self, filename):
+        """ Resolve a (Lexer(), source) for a file name (uncached).
+            The Lexer() is None when it should be guessed.
+            See `_lexer_source` for `source` names.
+        """
+        if self.lexername:
+            # Transform the user's lexer name into a real Lexer().
+            # Filename may be stdin (None, or '-', or anything falsey).
+            lexer = try_lexer(
+                self.lexername,
+                filename=filename,
+                fast=self.fast,
+            )
+            if lexer is None:
+                raise InvalidLexer('Bad lexer name', self.lexername)
+            return lexer, 'lexer'
+        # No lexer name was given, guess it or set known lexers by extension.
+        # If it's not one of these extensions a guess is forced later by
+        # returning `None`.
+        if filename_is_stdin(filename):
+            # No file to check extension.
+            return None, 'guess'
+
+        ext = os.path.splitext(filename)[-1].lower()
+        # Try the user's `lexers` config first.
+        lexername = self.ext_lexers.get(ext, None)
+        source = 'ext_lexers'
+        if lexername is None:
+            lexername = DEFAULT_EXT_LEXERS.get(ext, None)
+            source = 'default_ext'
+            if lexername is not None:
+                self.print_debug(
+                    'Set lexer name by default extension: {!r}'.format(ext),
+                    value=lexername,
+                )
+        else:
+            self.print_debug(
+                'Set lexer name by user config extension: {!r}'.format(ext),
+                value=lexername,
+            )
+        if lexername is None:
+            source = 'filename'
+        lexer = try_lexer(lexername, filename=filename, fast=self.fast)
+        return lexer, (source if lexer is not None else 'guess')
+
+    def print_debug(self, lbl, value=None):
+        """ Prints a formatted debug msg, if debug mode is enabled. """
+        if not self.debug:
+            return None
+        if value:
+            lbl = str(lbl).rjust(12)
+            print_status('{}:'.format(lbl), value=value)
+        else:
+            print_status(str(lbl))
+
+    def render_iter(self, source, name=None, lexer=None):
+        """ Render a file's content, yielding encoded lines (bytes).
+            Arguments:
+                source  : An open file object (text or binary), or the
+                          content itself (str).
+                name    : File name, used to pick a lexer and for the
+                          file name header. None means stdin.
+                lexer   : A Lexer() to use, instead of resolving one.
+        """
+        if (self.lines is not None) and self._lines_batched(name, lexer):
+            yield from self.stream_iter(source, name=name, lexer=lexer)
+            return
+        if (self.grep is not None) or (self.lines is not None):
+            yield from self._windows_iter(source, name=name, lexer=lexer)
+            return
+        if self.printnames:
+            yield self.encode('{}\n'.format(
+                self.format_filename(name or 'stdin')
+            ))
+        if self.nocolors:
+            # Colors have been disabled, there is no reason to
+            # use pygments at this point.
+            if self.metrics is not None:
+                self._count_file(None, 'none', None)
+            if self.linenos:
+                yield from self._pipe_linenos_iter(source)
+            else:
+                yield from self._pipe_iter(source)
+            return
+
+        content = self._read_text(source)
+        lexer = self._content_lexer(content, name=name, lexer=lexer)
+        tokens = self.lex(content, lexer, name=name)
+        if isinstance(self.formatter, formatters.HtmlFormatter):
+            yield from self.format_iter(tokens)
+            return
+        # Line numbers are the only reason to count lines.
+        lines = line_count(lexer_input(lexer, content)) if (
+            self.linenos
+        ) else 0
+        yield from self.format_windows(tokens, lines)
+
+    def render_fanout(self, source, sinks, name=None, lexer=None):
+        """ Lex a file's content once, and send the tokens to several
+            Sink()s, which format and write them in the background.
+            See `render_iter` for arguments.
+            Returns True on success (write errors are reported by
+            `Sink.close()`).
+        """
+        content = self._read_text(source)
+        lexer = self._content_lexer(content, name=name, lexer=lexer)
+        tokens = list(self.lex(content, lexer, name=name))
+        for sink in sinks:
+            sink.submit(name, tokens)
+        return True
+
+    def render_to(self, source, fileobj, name=None, lexer=None):
+        """ Render a file's content, and write it to an open file object.
+            Text files with a binary `buffer` are written to directly.
+            See `render_iter` for arguments.
+            Returns True on success.
+        """
+        write, flush = self._writer(fileobj)
+        written = 0
+        for chunk in self.render_iter(source, name=name, lexer=lexer):
+            write(chunk)
+            written += len(chunk)
+        flush()
+        self.count('output_bytes', written)
+        return True
+
+    def stream_iter(self, source, name=None, lexer=None):
+        """ Render a file object line by line as it arrives, yielding
+            encoded output for each batch of complete lines that was read.
+            A slow writer (`tail -f`) gets each line rendered as soon as it
+            is written, and a fast one gets bigger batches. Regular files
+            are read through a memory map, a chunk at a time. Lexer state is
+            carried from one batch to the next. Without a lexer name, the
+            lexer is guessed from the first batch.
+            Only the `lines` range is rendered, if it is set. Batches before
+            it are lexed (for the lexer state) but not formatted, and
+            reading stops after it. Blank lines at the start and end of the
+            file are skipped when the lexer strips them.
+            A line with no newline yet that grows past `window_size` (like
+            minified JSON) is rendered up to its last token, and the rest
+            waits for the next batch, so a whole line is never held. Tokens
+            that depend on text far ahead in the line (an INI value up to a
+            later quote, or one token longer than `window_size`) may be
+            colored differently at the cut. With
+            `grep` a line is only matched whole, so it is held until it
+            ends.
+            `token_cache`, `incremental`, and `time_budget` are not used.
+            Only for terminal formatters.
+            See `render_iter` for arguments.
+        """
+        if self.printnames:
+            yield self.encode('{}\n'.format(
+                self.format_filename(name or 'stdin')
+            ))
+        lexsource = 'none' if self.nocolors else 'given'
+        if (lexer is None) and (not self.nocolors):
+            lexer, lexsource = self._lexer_source(name)
+        if (self.metrics is not None) and (lexer is not None or self.nocolors):
+            self._count_file(lexer, lexsource, None)
+        grep = self.grep
+        firstline, lastline = self.lines or (1, None)
+        linenos = self.linenos or (grep is not None)
+        # For a line range, the gutter is as wide as the file's line count,
+        # like the whole-file path. Streams (and pipes) aren't counted, they
+        # get a fixed width.
+        total = None
+        if linenos and (self.lines is not None):
+            total = self._count_lines(source)
+        if total is not None:
+            width = len(str(max(total, 1)))
+        else:
+            width = len(str(lastline)) if lastline else 4
+        if self.nocolors and linenos:
+            def formatline(i, l):
+                return '{}: {}'.format(str(i).zfill(width), l)
+        else:
+            formatline = get_line_formatter(
+                10 ** (width - 1),
+                linenos=linenos,
+            )
+        separator = '--' if self.nocolors else color('--', fore='cyan')
+        stack = ('root',)
+        lineno = 0
+        # Context lines before the next --grep match, lines left to print
+        # after the last one, and the last line number printed.
+        before = deque(maxlen=self.context)
+        after = 0
+        printed = 0
+        # Text after the last newline, waiting for the rest of its line,
+        # and its length.
+        pending = []
+        pendingsize = 0
+        # Whether the last batch ended in the middle of a line, after some
+        # of it was rendered (`window_size`).
+        continued = False
+        # Whether any text was seen, and blank lines that were held back.
+        started = False
+        blanks = 0
+        chunks = self._map_chunks(source)
+        if chunks is None:
+            chunks = self._read_chunks(source)
+        try:
+            for chunk in itertools.chain(chunks, (None,)):
+                # Whether the batch ends in the middle of a line.
+                openline = False
+                if chunk is None:
+                    # End of file, the last line may not have a newline.
+                    if not (pending or continued):
+                        break
+                    pending.append('\n')
+                    text, pending = ''.join(pending), []
+                else:
+                    # Only complete lines are rendered.
+                    cut = chunk.rfind('\n') + 1
+                    if not cut:
+                        if chunk:
+                            pending.append(chunk)
+                            pendingsize += len(chunk)
+                        if (pendingsize <= self.window_size) or (
+                                grep is not None):
+                            continue
+                        text = ''.join(pending)
+                        # Lone '\r' line breaks. One at the end may be
+                        # part of a '\r\n'.
+                        cut = text.rfind('\r', 0, len(text) - 1) + 1
+                        if not cut:
+                            cut = len(text) - text.endswith('\r')
+                            openline = True
+                        chunk, pending = text, []
+                    pending.append(chunk[:cut])
+                    text = ''.join(pending)
+                    pending = [chunk[cut:]] if cut < len(chunk) else []
+                    pendingsize = len(chunk) - cut
+                if (not (lineno or continued)) and text.startswith('\ufeff'):
+                    text = text[len('\ufeff'):]
+                text = text.replace('\r\n', '\n').replace('\r', '\n')
+                rawlines = text.split('\n')
+                if not openline:
+                    rawlines.pop()
+                if (not self.nocolors) and (lexer is None):
+                    self.print_debug('guessed', True)
+                    lexer = try_lexer_guess(text, fast=self.fast)
+                    self.print_debug('lexer', lexer.name)
+                    if self.metrics is not None:
+                        self._count_file(lexer, lexsource, None)
+                if openline and not self.nocolors:
+                    # Render the line up to its last token, which may not
+                    # be complete yet.
+                    cut = self._stream_cut(text, lexer, stack)
+                    if cut < len(text):
+                        pending.insert(0, text[cut:])
+                        pendingsize += len(text) - cut
+                        text = text[:cut]
+                        rawlines = [text]
+                trimmed = False
+                if (not self.nocolors) and getattr(lexer, 'stripnl', False):
+                    # Like the lexer, skip blank lines at the start and end
+                    # of the file. Line numbers still count them.
+                    if not started:
+                        count = len(rawlines)
+                        while rawlines and (not rawlines[0]):
+                            rawlines.pop(0)
+                        lineno += count - len(rawlines)
+                        started = bool(rawlines)
+                    if rawlines:
+                        # Blank lines are held back until text follows them.
+                        # The rest of a continued line is not blank.
+                        rawlines[:0] = [''] * blanks
+                        count = len(rawlines)
+                        while (len(rawlines) > continued) and (
+                                not rawlines[-1]):
+                            rawlines.pop()
+                        blanks = count - len(rawlines)
+                    trimmed = True
+                if (lastline is not None) and (lineno >= lastline):
+                    break
+                if not rawlines:
+                    continue
+                if (lastline is not None) and (
+                        lineno + len(rawlines) > lastline):
+                    # Lines after the range are not lexed.
+                    rawlines = rawlines[:lastline - lineno]
+                    trimmed = True
+                    openline = False
+                if lineno + 1 < firstline:
+                    # Lines before the range are only lexed, for the state.
+                    skipped = rawlines[:firstline - 1 - lineno]
+                    rawlines = rawlines[len(skipped):]
+                    lineno += len(skipped)
+                    continued = False
+                    if openline and not rawlines:
+                        # The open line is before the range too.
+                        lineno -= 1
+                        continued = True
+                    if (not self.nocolors) and lexer_states_supported(lexer):
+                        skiptext = '\n'.join(skipped)
+                        if not continued:
+                            skiptext = '{}\n'.format(skiptext)
+                        self.count(
+                            'input_chars',
+                            len(skiptext),
+                            lexer=lexer.name,
+                        )
+                        _, stack = self._stream_lex(
+                            skiptext,
+                            lexer,
+                            stack,
+                            output=False,
+                        )
+                    if not rawlines:
+                        continue
+                    trimmed = True
+                if trimmed:
+                    text = '\n'.join(rawlines)
+                    if not openline:
+                        text = '{}\n'.format(text)
+                if self.nocolors:
+                    lines = rawlines
+                else:
+                    self.count('input_chars', len(text), lexer=lexer.name)
+                    hilite, stack = self._stream_lex(text, lexer, stack)
+                    lines = hilite.split('\n')
+                out = []
+                for raw, line in zip(rawlines, lines):
+                    lineno += 1
+                    if grep is None:
+                        out.append('{}\n'.format(formatline(lineno, line)))
+                        continue
+                    if grep.search(raw) is not None:
+                        first = before[0][0] if before else lineno
+                        if printed and (first > printed + 1):
+                            out.append('{}\n'.format(separator))
+                        out.extend(
+                            '{}\n'.format(formatline(i, l))
+                            for i, l in before
+                        )
+                        before.clear()
+                        out.append('{}\n'.format(formatline(lineno, line)))
+                        after = self.context
+                        printed = lineno
+                    elif after:
+                        out.append('{}\n'.format(formatline(lineno, line)))
+                        after -= 1
+                        printed = lineno
+                    elif self.context:
+                        before.append((lineno, line))
+                if continued:
+                    # The rest of a line that was started in the last batch
+                    # (there is no `grep`), it already has a line number.
+                    out[0] = '{}\n'.format(lines[0])
+                if openline:
+                    # The rest of this line comes with the next batch.
+                    out[-1] = out[-1][:-1]
+                    lineno -= 1
+                continued = openline
+                if out:
+                    yield self.encode(''.join(out))
+                if (lastline is not None) and (lineno >= lastline):
+                    # No need to read the rest of the file.
+                    break
+            if (not started) and (not self.nocolors) and getattr(
+                    lexer, 'stripnl', False):
+                # Only blank lines, the lexer still makes one empty line.
+                lineno += 1
+                inrange = (firstline <= lineno) and (
+                    (lastline is None) or (lineno <= lastline)
+                )
+                if inrange and ((grep is None) or grep.search('')):
+                    hilite, _ = self._stream_lex('\n', lexer, stack)
+                    yield self.encode('{}\n'.format(
+                        formatline(lineno, hilite.split('\n')[0])
+                    ))
+        finally:
+            chunks.close()
+
+    def stream_to(self, source, fileobj, name=None, lexer=None, flush=True):
+        """ Render a file object line by line as it arrives, and write it
+            to an open file object, flushing after each batch of lines if
+            `flush` is True.
+            See `stream_iter` for arguments.
+            Returns True on success.
+        """
+        write, flushfile = self._writer(fileobj)
+        for chunk in self.stream_iter(source, name=name, lexer=lexer):
+            write(chunk)
+            self.count('output_bytes', len(chunk))
+            if flush:
+                flushfile()
+        flushfile()
+        return True
+
+    def _get_record(self, name):
+        """ Return the last LexRecord() for a file name, or None. """
+        path = os.path.abspath(name)
+        with self._lock:
+            record = self._records.get(path, None)
+        if record is not None:
+            return record
+        cache = self.record_cache
+        if cache is None:
+            return None
+        blob = cache.get_blob(LexRecord.cache_key(path))
+        if blob is None:
+            return None
+        try:
+            return LexRecord.from_bytes(blob)
+        except (ValueError, UnicodeDecodeError) as ex:
+            self.print_debug('Bad saved lex record', str(ex))
+        return None
+
+    def _content_lexer(self, content, name=None, lexer=None):
+        """ Return the Lexer() to use for a file's content, and count the
+            file in `metrics`.
+        """
+        source = 'given'
+        if lexer is None:
+            lexer, source = self._lexer_source(name)
+        if lexer is None:
+            self.print_debug('guessed', True)
+            # try_lexer_guess() will fall back to 'text' lexer.
+            lexer = try_lexer_guess(content, fast=self.fast)
+        self.print_debug('lexer', lexer.name)
+        if isinstance(lexer, (FastJsonLexer, FastRegexLexer)):
+            self.print_debug('fast lexer', True)
+        if self.metrics is not None:
+            self._count_file(lexer, source, len(content))
+        return lexer
+
+    def _count_file(self, lexer, source, chars):
+        """ Count a file in `metrics`, with its Lexer() (or None), how the
+            lexer was picked, and its size in characters (or None).
+        """
+        lexername = 'none' if lexer is None else lexer.name
+        self.metrics.count('files', lexer=lexername)
+        self.metrics.count('lexer_sources', source=source)
+        if source == 'guess':
+            # Guesses that end up as plain text found nothing better.
+            plain = isinstance(lexer, lexers.TextLexer)
+            self.metrics.count('guesses', result='miss' if plain else 'hit')
+        if chars is not None:
+            self.metrics.count('input_chars', chars, lexer=lexername)
+            self.metrics.observe('file_chars', chars)
+
+    def _windows_iter(self, source, name=None, lexer=None):
+        """ Render the `lines` range, and lines matching `grep` with
+            `context` lines around them, yielding encoded lines. Only the
+            tokens inside the windows are formatted. For lexers where
+            `lexer_line_synced()` is True, only the windows are lexed.
+            Otherwise the file is lexed from the start, because the lexer's
+            state at a window depends on all the lines before it, and
+            lexing stops after the last window.
+        """
+        content = self._read_text(source)
+        if self.nocolors:
+            if self.metrics is not None:
+                self._count_file(None, 'none', len(content))
+            text = content
+            lead = 0
+        else:
+            lexer = self._content_lexer(content, name=name, lexer=lexer)
+            text = lexer_input(lexer, content)
+            # Leading lines stripped by the lexer, for real line numbers.
+            lead = _stripped_lines(lexer, content)
+        windows = None
+        if self.lines is not None:
+            firstline, lastline = self.lines
+            window = line_window(
+                text,
+                max(firstline - 1 - lead, 0),
+                None if lastline is None else lastline - 1 - lead,
+            )
+            windows = [window] if window else []
+        if self.grep is not None:
+            if windows is None:
+                windows = grep_windows(text, self.grep, context=self.context)
+            elif windows:
+                # Only search the range.
+                rangeline, _, rangestart, rangeend = windows[0]
+                windows = [
+                    (first + rangeline, last + rangeline,
+                     start + rangestart, end + rangestart)
+                    for first, last, start, end in grep_windows(
+                        text[rangestart:rangeend],
+                        self.grep,
+                        context=self.context,
+                    )
+                ]
+            self.print_debug('grep windows', len(windows))
+        if not windows:
+            return None
+        if self.printnames:
+            yield self.encode('{}\n'.format(
+                self.format_filename(name or 'stdin')
+            ))
+        width = len(str(text.count('\n') + lead))
+        linenos = self.linenos or (self.grep is not None)
+        if self.nocolors:
+            for i, (firstline, _, start, end) in enumerate(windows):
+                if i:
+                    yield self.encode('--\n')
+                # Windows end at a '\n', other line breaks are kept.
+                lines = text[start:end].split('\n')
+                if not lines[-1]:
+                    lines.pop()
+                for lineno, line in enumerate(
+                        lines,
+                        start=firstline + lead + 1):
+                    if linenos:
+                        line = '{}: {}'.format(str(lineno).zfill(width), line)
+                    yield self.encode('{}\n'.format(line))
+            return None
+
+        formatline = get_line_formatter(10 ** (width - 1), linenos=linenos)
+        separator = self.encode('{}\n'.format(color('--', fore='cyan')))
+        plain = (self.token_cache is None) and (not self.incremental) and (
+            not self.time_budget
+        )
+        if plain and lexer_line_synced(lexer):
+            # Each window is lexed on its own, the lines before it don't
+            # change its tokens.
+            self.print_debug('Lexing windows only', True)
+            tokens = self._lex_windows(text, lexer, windows)
+            if self.metrics is not None:
+                tokens = self._lex_timed(tokens, lexer)
+            for i, group in itertools.groupby(tokens, key=lambda t: t[0]):
+                yield from self._render_window(
+                    windows[i],
+                    [(ttype, value) for _, ttype, value in group],
+                    formatline,
+                    lead,
+                    separator if i else None,
+                )
+            return None
+        # Tokens for each window, clipped to the window.
+        wtokens = [[] for _ in windows]
+        current = 0
+        pos = 0
+        for ttype, value in self.lex(content, lexer, name=name):
+            tokenstart, pos = pos, pos + len(value)
+            while windows[current][3] <= tokenstart:
+                # This window is complete.
+                yield from self._render_window(
+                    windows[current],
+                    wtokens[current],
+                    formatline,
+                    lead,
+                    separator if current else None,
+                )
+                wtokens[current] = None
+                current += 1
+                if current == len(windows):
+                    # No need to lex the rest of the file.
+                    return None
+            for i in range(current, len(windows)):
+                _, _, start, end = windows[i]
+                if start >= pos:
+                    break
+                if (tokenstart >= start) and (pos <= end):
+                    wtokens[i].append((ttype, value))
+                else:
+                    # Token crosses the window's edge.
+                    clipped = value[
+                        max(start - tokenstart, 0):end - tokenstart
+                    ]
+                    if clipped:
+                        wtokens[i].append((ttype, clipped))
+        for i in range(current, len(windows)):
+            yield from self._render_window(
+                windows[i],
+                wtokens[i],
+                formatline,
+                lead,
+                separator if i else None,
+            )
+
+    def _lex_windows(self, text, lexer, windows):
+        """ Lex the text in each of `_windows_iter`'s windows, starting in
+            the 'root' state, yielding (window_index, tokentype, value).
+            Only for lexers where `lexer_line_synced()` is True.
+        """
+        for i, (_, _, start, end) in enumerate(windows):
+            tokens = []
+            for pos, ttype, value in get_tokens_states(lexer, text, start):
+                if pos >= end:
+                    break
+                tokens.append((ttype, value[:end - pos]))
+            if lexer.filters:
+                tokens = pygments.filter.apply_filters(
+                    tokens,
+                    lexer.filters,
+                    lexer,
+                )
+            for ttype, value in tokens:
+                yield i, ttype, value
+
+    def _render_window(self, window, tokens, formatline, lead, separator):
+        """ Format one window of tokens from `_windows_iter`, with real line
+            numbers, yielding encoded lines.
+        """
+        if separator:
+            yield separator
+        firstline, lastline, _, _ = window
+        # Windows end at a '\n', other line breaks are kept.
+        lines = pygments.format(tokens, self.formatter).split('\n')
+        for lineno, line in enumerate(
+                lines[:lastline - firstline + 1],
+                start=firstline + lead + 1):
+            yield self.encode('{}\n'.format(formatline(lineno, line)))
+
+    def _pipe_iter(self, source):
+        """ Straight file -> bytes piping. No frills/customization. """
+        self.print_debug('Piping file...')
+        if isinstance(source, str):
+            yield self.encode(source)
+            return
+        # Text files are read straight from their binary buffer, a chunk
+        # at a time.
+        read = getattr(source, 'buffer', source).read
+        while True:
+            data = read(self.map_chunk_size)
+            if not data:
+                break
+            yield data
+
+    def _pipe_linenos_iter(self, source):
+        """ Straight file -> bytes piping, with line numbers. """
+        self.print_debug('Piping file with line numbers...')
+        lines = self._read_text(source).splitlines(True)
+        width = len(str(len(lines)))
+        for i, line in enumerate(lines):
+            yield self.encode('{}: {}'.format(str(i).zfill(width), line))
+
+    def _set_record(self, name, record, save=True):
+        """ Keep the LexRecord() for a file name, and save it in
+            `record_cache` (if any) when `save` is True.
+        """
+        path = os.path.abspath(name)
+        with self._lock:
+            self._records.pop(path, None)
+            self._records[path] = record
+            if len(self._records) > self.record_cache_size:
+                self._records.popitem(last=False)
+        cache = self.record_cache
+        if save and (cache is not None):
+            cache.put(LexRecord.cache_key(path), record.to_bytes())
+
+    def _read_text(self, source):
+        """ Read all text from a file object, or return str content as-is.
+        """
+        if isinstance(source, str):
+            return source
+        chunks = self._map_chunks(source)
+        if chunks is not None:
+            # Regular files are decoded from a memory map a chunk at a time,
+            # instead of holding the bytes and the text at once.
+            content = ''.join(chunks)
+            if isinstance(source, io.TextIOBase) and ('\r' in content):
+                # Like reading a text file, with universal newlines.
+                content = content.replace('\r\n', '\n').replace('\r', '\n')
+            try:
+                source.seek(0, io.SEEK_END)
+            except (OSError, ValueError):
+                pass
+            return content
+        content = source.read()
+        if isinstance(content, bytes):
+            content = content.decode(self.encoding, self.errors)
+        return content
+
+    def _count_lines(self, source):
+        """ Count the lines in a file object's memory map, from the current
+            position, for the line number width. The count matches
+            `_windows_iter`: without colors it is the number of newlines,
+            otherwise trailing blank lines are not counted (the lexer strips
+            them). Returns None if the file can't be mapped (see
+            `_map_chunks`). The file position is not changed.
+        """
+        mapinfo = self._map_source(source)
+        if mapinfo is None:
+            # Empty files can't be mapped, but have no lines to count.
+            try:
+                fd = source.fileno()
+                st = os.fstat(fd)
+                if stat.S_ISREG(st.st_mode) and (
+                        st.st_size <= os.lseek(fd, 0, os.SEEK_CUR)):
+                    return 0
+            except (AttributeError, OSError, ValueError):
+                pass
+            return None
+        mapped, _, offset = mapinfo
+        dontneed = getattr(mmap, 'MADV_DONTNEED', None)
+        try:
+            end = len(mapped)
+            if not self.nocolors:
+                # Last byte that isn't a newline.
+                while end > offset:
+                    start = max(end - self.map_chunk_size, offset)
+                    tail = mapped[start:end].rstrip(b'\r\n')
+                    if tail:
+                        end = start + len(tail)
+                        break
+                    end = start
+                else:
+                    return 0
+            count = 0 if self.nocolors else 1
+            pos = offset
+            while pos < end:
+                chunkend = min(pos + self.map_chunk_size, end)
+                count += mapped[pos:chunkend].count(b'\n')
+                pagestart = pos - (pos % mmap.PAGESIZE)
+                pageend = chunkend - (chunkend % mmap.PAGESIZE)
+                if (dontneed is not None) and (pageend > pagestart):
+                    mapped.madvise(dontneed, pagestart, pageend - pagestart)
+                pos = chunkend
+            return count
+        finally:
+            mapped.close()
+
+    def _map_chunks(self, source):
+        """ Return a generator of str chunks from a file object's memory
+            map, or None if it isn't a regular file (or is empty, or its
+            encoding doesn't use b'\\n' for newlines).
+            Chunks are decoded as they are read, and the pages that were
+            read are dropped from memory, so memory use doesn't grow with
+            the file size.
+        """
+        mapinfo = self._map_source(source)
+        if mapinfo is None:
+            return None
+        mapped, encoding, offset = mapinfo
+        decoder = codecs.getincrementaldecoder(encoding)(
+            getattr(source, 'errors', None) or self.errors
+        )
+        return self._mapped_chunks(mapped, decoder, offset)
+
+    def _map_source(self, source):
+        """ Memory map a file object for `_map_chunks`.
+            Returns (mmap, encoding, offset), or None if it can't be used.
+        """
+        if isinstance(source, str):
+            return None
+        try:
+            fd = source.fileno()
+            st = os.fstat(fd)
+            offset = os.lseek(fd, 0, os.SEEK_CUR)
+        except (AttributeError, OSError, ValueError):
+            return None
+        if (not stat.S_ISREG(st.st_mode)) or (st.st_size <= offset):
+            return None
+        encoding = getattr(source, 'encoding', None) or self.encoding
+        try:
+            if '\n'.encode(encoding) != b'\n':
+                return None
+        except LookupError:
+            return None
+        try:
+            mapped = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        return mapped, encoding, offset
+
+    def _mapped_chunks(self, mapped, decoder, pos=0):
+        """ Yield decoded str chunks from an mmap, starting at `pos`, and
+            close it when done. See `_map_chunks`.
+        """
+        dontneed = getattr(mmap, 'MADV_DONTNEED', None)
+        # Start of the pages that haven't been dropped yet.
+        dropped = pos - (pos % mmap.PAGESIZE)
+        size = self.map_chunk_size
+        try:
+            while pos < len(mapped):
+                end = min(pos + size, len(mapped))
+                yield decoder.decode(mapped[pos:end])
+                pos = end
+                pageend = end - (end % mmap.PAGESIZE)
+                if (dontneed is not None) and (pageend > dropped):
+                    mapped.madvise(dontneed, dropped, pageend - dropped)
+                    dropped = pageend
+            yield decoder.decode(b'', True)
+        finally:
+            mapped.close()
+
+    def _read_chunks(self, source, size=16384):
+        """ Read text from a file object as it arrives, yielding str
+            chunks. The file descriptor is read directly, which returns
+            whatever is available instead of waiting for a full buffer.
+        """
+        if isinstance(source, str):
+            yield source
+            return
+        try:
+            fd = source.fileno()
+        except (AttributeError, OSError, ValueError):
+            fd = None
+        if fd is None:
+            # No file descriptor (io.StringIO), read it line by line.
+            for line in source:
+                if isinstance(line, bytes):
+                    line = line.decode(self.encoding, self.errors)
+                yield line
+            return
+        decoder = codecs.getincrementaldecoder(
+            getattr(source, 'encoding', None) or self.encoding
+        )(getattr(source, 'errors', None) or self.errors)
+        while True:
+            data = os.read(fd, size)
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b'', True)
+
+    def _stream_cut(self, text, lexer, stack):
+        """ Return an offset to cut a long line that has no newline yet at,
+            lexed from the saved state `stack`, so `stream_iter` can render
+            the line up to there. The last token may change when the rest
+            of the line arrives, and some token types depend on the next
+            token (a JSON string followed by ':' is a key), so the line is
+            cut after the last punctuation before the last token, or at the
+            start of the last token if there is none.
+            Returns len(text) if the line is one token so far.
+        """
+        if lexer_states_supported(lexer):
+            tokens = get_tokens_states(lexer, text, stack=stack)
+        else:
+            tokens = lexer.get_tokens_unprocessed(text)
+        Punctuation = token.Punctuation
+        last = punctuation = 0
+        lasttype = None
+        for index, ttype, value in tokens:
+            if not value:
+                continue
+            if last and (lasttype in Punctuation):
+                punctuation = index
+            last, lasttype = index, ttype
+        return punctuation or last or len(text)
+
+    def _stream_lex(self, text, lexer, stack, output=True):
+        """ Lex and format a batch of complete lines for `stream_iter`,
+            starting in the saved state `stack`.
+            Returns (formatted_text, stack), with the state for the next
+            batch. If `output` is False, the batch is only lexed, for the
+            state, and formatted_text is None.
+        """
+        if lexer.tabsize > 0:
+            text = text.expandtabs(lexer.tabsize)
+        states = None
+        if lexer_states_supported(lexer):
+            states = {}
+            tokens = get_tokens_states(lexer, text, stack=stack, states=states)
+            if not output:
+                deque(tokens, maxlen=0)
+                return None, states.get(len(text), ('root',))
+        else:
+            # No saved states, every batch starts in the root state.
+            tokens = lexer.get_tokens_unprocessed(text)
+        tokens = _drop_index(tokens)
+        if lexer.filters:
+            tokens = pygments.filter.apply_filters(
+                tokens,
+                lexer.filters,
+                lexer,
+            )
+        if self.metrics is not None:
+            tokens = self._lex_timed(tokens, lexer, perfile=False)
+        formatted = pygments.format(tokens, self.formatter)
+        if states is not None:
+            stack = states.get(len(text), ('root',))
+        return formatted, stack
+
+    def _lines_batched(self, name, lexer):
+        """ Returns True if the `lines` range of a file can be rendered in
+            batches by `stream_iter`, with the same tokens as lexing the
+            whole file. That needs a lexer that can resume at the start of
+            any line (`lexer_resumable()`), and nothing else that needs the
+            whole text (token caches, time budgets, html).
+        """
+        if self.nocolors:
+            return True
+        if (
+                self.token_cache is not None or
+                self.incremental or
+                self.time_budget or
+                isinstance(self.formatter, formatters.HtmlFormatter)):
+            return False
+        if lexer is None:
+            lexer = self.lexer_for(name)
+        # A lexer is guessed from the whole text.
+        return (lexer is not None) and lexer_resumable(lexer)
+
+    def _writer(self, fileobj):
+        """ Return (write, flush) functions for an open file object.
+            Text files with a binary `buffer` are written to directly.
+        """
+        buffer = getattr(fileobj, 'buffer', None)
+        if buffer is None:
+            if isinstance(fileobj, io.TextIOBase):
+                def write(b):
+                    fileobj.write(b.decode(self.encoding, self.errors))
+            else:
+                def write(b):
+                    write_all(fileobj, b)
+            return write, fileobj.flush
+        # Anything already written to the text layer goes first.
+        fileobj.flush()
+
+        def write(b):
+            write_all(buffer, b)
+        return write, buffer.flush
+
+
+class Sink(object):
+    """ One output for fan-out rendering (`Printer.render_fanout()`).
+        Tokens are formatted and written by a background thread, in the
+        order they were submitted.
+    """
+    # Maximum number of files waiting to be written.
+    queue_size = 8
+
+    def __init__(self, printer, formatter, dest, linenos=False):
+        """ Initialize a Sink, and start its writer thread.
+            Arguments:
+                printer   : The Printer() that lexes files for this Sink.
+                formatter : A pygments Formatter().
+                dest      : '-' for stdout, a directory name ending with a
+                            path separator for a file per input, or a
+                            file name.
+                linenos   : Whether to print line numbers.
+        """
+        self.printer = printer
+        self.formatter = formatter
+        self.dest = dest
+        self.linenos = linenos
+        self.ext = '.txt'
+        for info in FORMATTERS.values():
+            if isinstance(formatter, info['class']):
+                self.ext = info.get('ext', self.ext)
+        self.error = None
+        self._file = None
+        # Input file for each output file path, when `is_dir`.
+        self._sources = {}
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='ccat-sink: {}'.format(dest),
+            daemon=True,
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return '{}({!r}, {!r})'.format(
+            type(self).__name__,
+            type(self.formatter).__name__,
+            self.dest,
+        )
+
+    @property
+    def is_dir(self):
+        """ True if this Sink writes a file for each input. """
+        return self.dest.endswith(os.sep)
+
+    def close(self):
+        """ Wait for everything to be written, and close the output.
+            Returns True if there were no write errors (see `error`).
+        """
+        self._queue.put(None)
+        self._thread.join()
+        return self.error is None
+
+    def submit(self, name, tokens):
+        """ Queue a file's tokens to be formatted and written.
+            Blocks while the queue is full.
+        """
+        self._queue.put((name, tokens))
+
+    def _output_path(self, name):
+        """ Return the file path to write a single input to.
+            Inputs outside of the current directory are written by their
+            base name, with a number added when another input already
+            used that name.
+        """
+        if filename_is_stdin(name):
+            relpath = 'stdin'
+        else:
+            relpath = os.path.normpath(name)
+            outside = (
+                os.path.isabs(relpath) or
+                (relpath == os.pardir) or
+                relpath.startswith(os.pardir + os.sep)
+            )
+            if outside:
+                relpath = os.path.basename(relpath)
+        source = None if filename_is_stdin(name) else os.path.abspath(name)
+        filepath = os.path.join(self.dest, '{}{}'.format(relpath, self.ext))
+        n = 1
+        while self._sources.setdefault(filepath, source) != source:
+            n += 1
+            filepath = os.path.join(
+                self.dest,
+                '{}.{}{}'.format(relpath, n, self.ext),
+            )
+        return filepath
+
+    def _run(self):
+        """ Format and write queued files until `close()` is called. """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep draining the queue, so submit() never blocks.
+                continue
+            try:
+                self._write(*item)
+            except Exception as ex:
+                # Any error (like UnicodeEncodeError) stops writing, but the
+                # thread has to live on, or submit() and close() would hang.
+                self.error = ex
+        if (self._file is not None) and (self.dest != '-'):
+            try:
+                self._file.close()
+            except EnvironmentError as ex:
+                self.error = self.error or ex
+
+    def _write(self, name, tokens):
+        """ Format and write a single file's tokens. """
+        lines = self.printer.format_iter(
+            tokens,
+            formatter=self.formatter,
+            linenos=self.linenos,
+        )
+        if self.printer.metrics is not None:
+            lines = list(lines)
+            self.printer.count('output_bytes', sum(map(len, lines)))
+        if self.is_dir:
+            filepath = self._output_path(name)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'wb') as f:
+                f.writelines(lines)
+            return None
+
+        if self._file is None:
+            if self.dest == '-':
+                sys.stdout.flush()
+                self._file = sys.stdout.buffer
+            else:
+                self._file = open(self.dest, 'wb')
+        ishtml = isinstance(self.formatter, formatters.HtmlFormatter)
+        if self.printer.printnames and not ishtml:
+            write_all(self._file, self.printer.encode('{}\n'.format(
+                self.printer.format_filename(name or 'stdin')
+            )))
+        for line in lines:
+            write_all(self._file, line)
+        self._file.flush()
+
+
+class StyleTables(object):
+    """ Escape tables for the 256 color and truecolor formatters, as
+        {str(tokentype): (on, off)}, built once per style and formatter
+        options, and shared by every formatter instance. Matching a style's
+        colors to the 256 color palette is most of the cost of creating a
+        Terminal256Formatter().
+        When a `directory` is given, tables are also saved there, so later
+        runs don't build them at all.
+        Thread-safe.
+    """
+
+    def __init__(self, directory=None):
+        """ Initialize StyleTables.
+            Arguments:
+                directory  : Directory to save tables in, or None.
+        """
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __repr__(self):
+        return '{}(directory={!r})'.format(type(self).__name__, self.directory)
+
+    def get(self, formatter, build):
+        """ Return the escape table for a formatter, calling `build()` to
+            make it when it isn't in memory or saved in `directory`.
+        """
+        key = self.key(formatter)
+        with self._lock:
+            table = self._tables.get(key, None)
+        if table is None:
+            table = self._load(key)
+        with self._lock:
+            if table is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if table is None:
+            table = build()
+            self._save(key, table)
+        with self._lock:
+            self._tables[key] = table
+        return table
+
+    @staticmethod
+    def key(formatter):
+        """ Return a str key for a formatter's escape table. """
+        style = formatter.style
+        return '\0'.join((
+            pygments.__version__,
+            formatter.name,
+            '{}.{}'.format(style.__module__, style.__qualname__),
+            repr((
+                formatter.usebold,
+                formatter.useunderline,
+                formatter.useitalic,
+            )),
+        ))
+
+    def stats(self):
+        """ Return a dict of table stats, for debug mode. """
+        with self._lock:
+            return {
+                'tables': len(self._tables),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def _filepath(self, key):
+        """ Return the file path for a table in `directory`, or None. """
+        if not self.directory:
+            return None
+        return os.path.join(
+            self.directory,
+            '{}.json'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()),
+        )
+
+    def _load(self, key):
+        """ Load a saved table from `directory`, or return None. """
+        filepath = self._filepath(key)
+        if filepath is None:
+            return None
+        try:
+            with open(filepath, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (EnvironmentError, ValueError) as ex:
+            print_debug('Unable to load style table', str(ex))
+            return None
+        if (not isinstance(saved, dict)) or (saved.get('key', None) != key):
+            return None
+        try:
+            table = {}
+            for ttype, (on, off) in saved['table'].items():
+                if not (isinstance(on, str) and isinstance(off, str)):
+                    raise TypeError('Escapes must be strings.')
+                table[ttype] = (on, off)
+        except (AttributeError, KeyError, TypeError, ValueError) as ex:
+            # Valid JSON, but not a saved table.
+            print_debug('Bad style table', repr(ex))
+            return None
+        return table
+
+    def _save(self, key, table):
+        """ Save a table in `directory`.
+            Errors are ignored, the tables are only an optimization.
+        """
+        filepath = self._filepath(key)
+        if filepath is None:
+            return None
+        tmppath = '{}.{}.tmp'.format(filepath, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmppath, 'w') as f:
+                json.dump({'key': key, 'table': table}, f)
+            os.replace(tmppath, filepath)
+        except EnvironmentError as ex:
+            print_debug('Unable to save style table', str(ex))
+
+
+# Shared escape tables for CachedTerminal256Formatter, and
+# CachedTrueColorFormatter.
+styletables = StyleTables(directory=os.path.join(CACHEDIR, 'styles'))
+
+
+class CachedTerminal256Formatter(formatters.Terminal256Formatter):
+    """ A Terminal256Formatter() that gets its escape table from
+        `styletables`, so the palette matching only runs once per style.
+    """
+
+    def _build_color_table(self):
+        # Only used by _closest_color(), in _build_styles().
+        pass
+
+    def _build_styles(self):
+        """ Build the escape table, the way Terminal256Formatter() does. """
+        super()._build_color_table()
+        super()._setup_styles()
+        return self.style_string
+
+    def _setup_styles(self):
+        self.style_string = styletables.get(self, self._build_styles)
+
+
+class CachedTrueColorFormatter(formatters.TerminalTrueColorFormatter):
+    """ A TerminalTrueColorFormatter() that gets its escape table from
+        `styletables`.
+    """
+
+    def _build_styles(self):
+        """ Build the escape table, the way TerminalTrueColorFormatter()
+            does.
+        """
+        super()._setup_styles()
+        return self.style_string
+
+    def _setup_styles(self):
+        self.style_string = styletables.get(self, self._build_styles)
+
+
+# The palette formatters share their escape tables.
+FORMATTERS['256']['class'] = CachedTerminal256Formatter
+FORMATTERS['truecolor']['class'] = CachedTrueColorFormatter
+
+
+class TokenCache(object):
+    """ A size-bounded cache of lexed token streams, keyed by a hash of the
+        content and the Lexer(). Only the formatter has to run when the same
+        content is rendered again with another style or formatter.
+        Entries are stored compactly, with token types interned to small ints
+        and values stored as end offsets into the content.
+        When a `directory` is given, entries are also saved there, so they
+        can be reused by later runs.
+        Thread-safe.
+    """
+    # Header for a serialized entry: magic, type count, token count,
+    # and length of the type names.
+    header = struct.Struct('<4sHII')
+    magic = b'CCT1'
+
+    def __init__(self, maxsize=64 * 1024 * 1024, directory=None,
+                 maxdisksize=256 * 1024 * 1024):
+        """ Initialize a TokenCache.
+            Arguments:
+                maxsize     : Maximum bytes for entries kept in memory.
+                directory   : Directory to save entries in, or None.
+                maxdisksize : Maximum bytes for entries saved in `directory`.
+        """
+        self.maxsize = maxsize
+        self.directory = directory
+        self.maxdisksize = maxdisksize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # Total size of `directory`, measured when first needed.
+        self.disksize = None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '{}({})'.format(
+            type(self).__name__,
+            ', '.join(
+                '{}={!r}'.format(k, v)
+                for k, v in sorted(self.stats().items())
+            )
+        )
+
+    @classmethod
+    def decode(cls, blob, text):
+        """ Decode a serialized entry into a list of (tokentype, value),
+            using the content it was made from.
+            Raises ValueError for bad entries.
+        """
+        try:
+            magic, ntypes, ntokens, nameslen = cls.header.unpack_from(blob)
+        except struct.error as ex:
+            raise ValueError('Bad token cache entry: {}'.format(ex)) from ex
+        if magic != cls.magic:
+            raise ValueError('Bad token cache entry: {!r}'.format(magic))
+        start = cls.header.size
+        names = blob[start:start + nameslen].decode('utf-8').split('\n')
+        start += nameslen
+        types = array.array('H')
+        types.frombytes(blob[start:start + (ntokens * types.itemsize)])
+        start += ntokens * types.itemsize
+        ends = array.array('I')
+        ends.frombytes(blob[start:start + (ntokens * ends.itemsize)])
+        if sys.byteorder == 'big':
+            types.byteswap()
+            ends.byteswap()
+        if (
+                (len(names) != ntypes) or
+                (len(ends) != ntokens) or
+                (ntokens and (ends[-1] != len(text)))):
+            raise ValueError('Bad token cache entry, wrong size.')
+        if ntokens and (max(types) >= ntypes):
+            raise ValueError('Bad token cache entry, unknown token type.')
+
+        ttypes = [token.string_to_tokentype(name) for name in names]
+        tokens = []
+        pos = 0
+        for typeid, end in zip(types, ends):
+            tokens.append((ttypes[typeid], text[pos:end]))
+            pos = end
+        return tokens
+
+    @classmethod
+    def encode(cls, ttypes, types, ends):
+        """ Serialize an entry.
+            Arguments:
+                ttypes : List of token types, in order of their ids.
+                types  : array('H') of token type ids.
+                ends   : array('I') of token end offsets.
+        """
+        names = '\n'.join('.'.join(ttype) for ttype in ttypes).encode()
+        if sys.byteorder == 'big':
+            types, ends = array.array('H', types), array.array('I', ends)
+            types.byteswap()
+            ends.byteswap()
+        return b''.join((
+            cls.header.pack(cls.magic, len(ttypes), len(types), len(names)),
+            names,
+            types.tobytes(),
+            ends.tobytes(),
+        ))
+
+    def get(self, key, text):
+        """ Return a list of cached (tokentype, value) for this key and
+            content, or None if it is not cached.
+        """
+        blob = self.get_blob(key)
+        tokens = None
+        if blob is not None:
+            try:
+                tokens = self.decode(blob, text)
+            except (ValueError, UnicodeDecodeError):
+                self.remove(key)
+        with self._lock:
+            if tokens is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return tokens
+
+    def get_blob(self, key):
+        """ Return a raw serialized entry, or None if it is not cached. """
+        with self._lock:
+            blob = self._entries.get(key, None)
+            if blob is not None:
+                self._entries.move_to_end(key)
+                return blob
+        return self._load(key)
+
+    @staticmethod
+    def key(text, lexer):
+        """ Build a cache key from preprocessed content and a Lexer(). """
+        h = hashlib.sha1(text.encode('utf-8', 'surrogatepass'))
+        h.update(lexer_key(lexer).encode('utf-8', 'replace'))
+        return h.hexdigest()
+
+    def put(self, key, blob):
+        """ Cache a serialized entry (see `encode`), evicting the least
+            recently used entries when `maxsize` is exceeded.
+        """
+        self._keep(key, blob)
+        self._save(key, blob)
+
+    def record(self, key, text, tokens):
+        """ Pass (tokentype, value) tokens through, and cache them once
+            they are exhausted. Nothing is cached if the tokens don't cover
+            the content exactly, or the token stream returns a value
+            (from a time budget fallback).
+            Returns the token stream's return value.
+        """
+        ttypes = []
+        typeids = {}
+        types = array.array('H')
+        ends = array.array('I')
+        pos = 0
+        exact = True
+        tokens = iter(tokens)
+        while True:
+            try:
+                ttype, value = next(tokens)
+            except StopIteration as stop:
+                result = stop.value
+                break
+            if exact:
+                typeid = typeids.get(ttype, None)
+                if typeid is None:
+                    typeid = typeids[ttype] = len(ttypes)
+                    ttypes.append(ttype)
+                exact = text.startswith(value, pos) and (typeid < 0xffff)
+                pos += len(value)
+                types.append(typeid)
+                ends.append(pos)
+            yield ttype, value
+        if exact and (result is None) and (pos == len(text)):
+            self.put(key, self.encode(ttypes, types, ends))
+        return result
+
+    def remove(self, key):
+        """ Remove an entry from memory and disk, if it exists. """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+        filepath = self._filepath(key)
+        if filepath is None:
+            return None
+        try:
+            size = os.path.getsize(filepath)
+            os.remove(filepath)
+        except EnvironmentError:
+            return None
+        with self._lock:
+            if self.disksize is not None:
+                self.disksize -= size
+
+    def stats(self):
+        """ Return a dict of cache counters. """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'evictions': self.evictions,
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': self.size,
+            }
+
+    def _filepath(self, key):
+        """ Return the file path for an entry in `directory`, or None. """
+        if not self.directory:
+            return None
+        return os.path.join(self.directory, '{}.tokens'.format(key))
+
+    def _keep(self, key, blob):
+        """ Keep a serialized entry in memory, evicting the least recently
+            used entries when `maxsize` is exceeded.
+        """
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(blob) <= self.maxsize:
+                self._entries[key] = blob
+                self.size += len(blob)
+            while self.size > self.maxsize:
+                _, old = self._entries.popitem(last=False)
+                self.size -= len(old)
+                self.evictions += 1
+
+    def _load(self, key):
+        """ Load a serialized entry from `directory`, and keep it in memory.
+            Returns None if it is not saved.
+        """
+        filepath = self._filepath(key)
+        if filepath is None:
+            return None
+        try:
+            with open(filepath, 'rb') as f:
+                blob = f.read()
+            # Mark it as recently used, for disk eviction.
+            os.utime(filepath)
+        except EnvironmentError:
+            return None
+        self._keep(key, blob)
+        return blob
+
+    def _save(self, key, blob):
+        """ Save a serialized entry in `directory`, evicting the least
+            recently used files when `maxdisksize` is exceeded.
+            Errors are ignored, the cache is only an optimization.
+        """
+        filepath = self._filepath(key)
+        if filepath is None:
+            return None
+        tmppath = '{}.{}.tmp'.format(filepath, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmppath, 'wb') as f:
+                f.write(blob)
+            os.replace(tmppath, filepath)
+        except EnvironmentError as ex:
+            print_debug('Unable to save token cache entry', str(ex))
+            return None
+        with self._lock:
+            if self.disksize is None:
+                self.disksize = sum(size for _, _, size in self._disk_files())
+            else:
+                self.disksize += len(blob)
+            if self.disksize <= self.maxdisksize:
+                return None
+            # Evict down to 90%, so it doesn't happen on every save.
+            for _, path, size in sorted(self._disk_files()):
+                if self.disksize <= (self.maxdisksize * 0.9):
+                    break
+                try:
+                    os.remove(path)
+                except EnvironmentError:
+                    continue
+                self.disksize -= size
+                self.evictions += 1
+
+    def _disk_files(self):
+        """ Yield (mtime, path, size) for all entries in `directory`. """
+        try:
+            names = os.listdir(self.directory)
+        except EnvironmentError:
+            return None
+        for name in names:
+            if not name.endswith('.tokens'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except EnvironmentError:
+                continue
+            yield st.st_mtime, path, st.st_size
+
+
+class Writer(object):
+    """ Writes encoded output to a file object from a background thread,
+        so lexing and formatting the next chunk overlaps with writing the
+        last one (slow terminals, ssh sessions).
+        Writes are joined into chunks of about `buffer_size` bytes, and
+        `write()` blocks when `queue_size` chunks are waiting to be
+        written. Each chunk is written in full, even to a raw file that
+        takes part of it at a time, and `bytes` only counts what the file
+        took. When the file is closed on the other end
+        (BrokenPipeError), the rest of the output is dropped, and the
+        error is raised by the next `write()` or `flush()`.
+        `flush()` doesn't wait for the thread unless asked to, so the
+        next file can be lexed while the last one is written.
+    """
+    buffer_size = 65536
+    queue_size = 4
+
+    def __init__(self, fileobj):
+        """ Initialize a Writer, and start its thread.
+            Arguments:
+                fileobj  : A file object opened for binary writing, or a
+                           text file object with a binary `buffer`.
+        """
+        buffer = getattr(fileobj, 'buffer', None)
+        if buffer is not None:
+            # Anything already written to the text layer goes first.
+            fileobj.flush()
+            fileobj = buffer
+        self.fileobj = fileobj
+        # An EnvironmentError from writing, if any.
+        self.error = None
+        self.bytes = 0
+        # Seconds the thread spent writing, and the producer spent waiting
+        # on a full queue.
+        self.write_time = 0.0
+        self.wait_time = 0.0
+        self.waits = 0
+        self.started = time.perf_counter()
+        self.stopped = None
+        self._buffer = []
+        self._buffered = 0
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._thread = threading.Thread(
+            target=self._run,
+            name='ccat-writer',
+            daemon=True,
+        )
+        self._thread.start()
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.fileobj)
+
+    def close(self):
+        """ Write everything that is left, and stop the thread.
+            Returns True on success, or False if there was an error
+            (see `error`).
+        """
+        if self.stopped is not None:
+            return self.error is None
+        self._send()
+        self._put(None)
+        self._thread.join()
+        if self.error is None:
+            try:
+                self.fileobj.flush()
+            except EnvironmentError as ex:
+                self.error = ex
+        self.stopped = time.perf_counter()
+        return self.error is None
+
+    def flush(self, wait=False):
+        """ Queue everything buffered so far to be written and flushed.
+            If `wait` is True, block until it has been written.
+        """
+        if self.error is not None:
+            raise self.error
+        self._send()
+        done = threading.Event()
+        self._put(done)
+        if not wait:
+            return None
+        done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def stats(self):
+        """ Return a dict of output stats, for debug mode. """
+        seconds = (self.stopped or time.perf_counter()) - self.started
+        return {
+            'bytes': self.bytes,
+            'seconds': round(seconds, 4),
+            'MB/s': round(self.bytes / (seconds or 1) / 1e6, 2),
+            'write_seconds': round(self.write_time, 4),
+            'write_MB/s': round(self.bytes / (self.write_time or 1) / 1e6, 2),
+            'queue_waits': self.waits,
+            'queue_wait_seconds': round(self.wait_time, 4),
+        }
+
+    def write(self, b):
+        """ Queue bytes to be written, blocking if the queue is full.
+            Returns the number of bytes.
+        """
+        if self.error is not None:
+            raise self.error
+        self._buffer.append(b)
+        self._buffered += len(b)
+        if self._buffered >= self.buffer_size:
+            self._send()
+        return len(b)
+
+    def _put(self, item):
+        """ Put an item in the queue, timing any wait for a free slot. """
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            start = time.perf_counter()
+            self._queue.put(item)
+            self.wait_time += time.perf_counter() - start
+            self.waits += 1
+
+    def _run(self):
+        """ Write queued chunks until close() is called.
+            Events are set after the file is flushed, for `flush()`.
+        """
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                if self.error is None:
+                    try:
+                        self.fileobj.flush()
+                    except EnvironmentError as ex:
+                        self.error = ex
+                item.set()
+                continue
+            if self.error is not None:
+                # Output is dropped after an error.
+                continue
+            start = time.perf_counter()
+            view = memoryview(item)
+            try:
+                # Raw files may only write part of it, see `write_all()`.
+                while view:
+                    written = self.fileobj.write(view)
+                    if written is None:
+                        written = len(view)
+                    self.bytes += written
+                    view = view[written:]
+            except EnvironmentError as ex:
+                self.error = ex
+                continue
+            self.write_time += time.perf_counter() - start
+
+    def _send(self):
+        """ Queue the buffered bytes as one chunk. """
+        if not self._buffer:
+            return None
+        chunk = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._put(chunk)
+
+
+class _ColorDocoptExit(SystemExit):
+
+    """ Custom DocoptExit class, colorizes the help text. """
+
+    usage = ''
+
+    def __init__(self, message=''):
+        usagestr = '{}\n{}'.format(message,
+                                   _coloredhelp(self.usage)).strip()
+        SystemExit.__init__(self, usagestr)
+
+
+def _coloredhelp(s):
+    """ Colorize the usage string for docopt
         (ColorDocoptExit, docoptextras)
     """
     newlines = []
@@ -1008,7 +5015,7 @@ class InvalidConfig(ValueError):
             s = '\n'.join((
                 s,
                 '\n{}:'.format(color(type(self.exc).__name__, 'magenta')),
-                color(self.exc, 'red'),
+                color(str(self.exc), 'red'),
             ))
         return s
 
@@ -1039,6 +5046,17 @@ class InvalidArg(InvalidConfig):
     default_fmt = 'Invalid argument, {}'
 
 
+class LexTimeout(Exception):
+    """ Raised when lexing a file runs past the Printer's time budget. """
+    pass
+
+
+class InvalidLexer(InvalidArg):
+    """ Raised when a lexer name can't be transformed into a Lexer(). """
+    default_str = 'Invalid lexer name!'
+    default_fmt = 'Invalid lexer name, {}'
+
+
 # Functions to override default docopt stuff
 docopt.DocoptExit = _ColorDocoptExit
 docopt.extras = _docoptextras
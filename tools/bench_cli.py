@@ -0,0 +1,400 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_cli.py
+    Runs ccat.py as a command over a generated corpus, measures the wall
+    time, CPU time, and max RSS of each case, and compares them against a
+    saved baseline. Exits with 1 when a case is slower, or uses more
+    memory, than the baseline allows.
+
+    Usage:
+        tools/bench_cli.py [-n runs] [-b file] [-t spec] [-u] [-k] [CASE...]
+
+    Options:
+        CASE     : Only run these cases. Default: all of them.
+        -b file  : Baseline JSON file.
+                   Default: tools/bench_cli_baseline.json
+        -k       : Keep the generated corpus (in a temporary directory).
+        -n runs  : Runs of each case. The fastest run's times, and the
+                   median max RSS, are used. Default: 5
+        -t spec  : Allowed increase over the baseline, as comma-separated
+                   NAME=PERCENT pairs for wall, cpu, and rss.
+                   Default: wall=25,cpu=25,rss=15
+        -u       : Write the results as the new baseline, instead of
+                   comparing them.
+
+    Cases:
+        version      : Cold start, `ccat -v`.
+        lexers       : Cold start, `ccat -L`.
+        cat-nocolors : A 4 MiB Python file with -C, piped.
+        highlight    : A 1 MiB Python file with -c, piped.
+        many-small   : 400 small files of several languages, with -c.
+        stdin-guess  : 64 KiB of Python on stdin, guessing the lexer.
+
+    Times depend on the machine, and on what else it is doing. A small
+    Python loop is timed between the runs of each case, and the baseline
+    times are scaled by how much faster or slower it is now than when the
+    baseline was written. That evens out a busy or throttled machine, but
+    a baseline written on the machine that is checked is still best.
+"""
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+CCAT = os.path.join(os.path.dirname(SCRIPTDIR), 'ccat.py')
+BASELINE = os.path.join(SCRIPTDIR, 'bench_cli_baseline.json')
+
+# Allowed increase over the baseline, in percent.
+TOLERANCE = {'wall': 25, 'cpu': 25, 'rss': 15}
+# Differences under these are noise, whatever the percentage.
+SLACK = {'wall': 0.05, 'cpu': 0.05, 'rss': 2.0}
+UNITS = {'wall': 's', 'cpu': 's', 'rss': 'MiB'}
+
+# Fixed CPU work, timed to see how fast the machine is right now.
+CALIBRATE = '''
+d = {}
+for i in range(300000):
+    d[str(i)] = i * i
+'''
+
+# Case name, ccat arguments, and the corpus file used for stdin (or None).
+# Arguments are formatted with the corpus paths (see `make_corpus()`).
+CASES = (
+    ('version', ['-v'], None),
+    ('lexers', ['-L'], None),
+    ('cat-nocolors', ['--nosave', '-C', '{big}'], None),
+    ('highlight', ['--nosave', '-c', '-l', 'python', '{medium}'], None),
+    ('many-small', ['--nosave', '-c', '--files-from', '{small}'], None),
+    ('stdin-guess', ['--nosave', '-c', '-g'], 'stdin'),
+)
+
+WORDS = (
+    'alpha', 'beta', 'count', 'data', 'entry', 'field', 'group', 'handle',
+    'index', 'join', 'key', 'label', 'value', 'name', 'offset', 'parent',
+)
+
+
+def python_block(rnd, n):
+    """ Return some Python source for block number `n`. """
+    a, b, c = rnd.sample(WORDS, 3)
+    return '\n'.join((
+        'class {}{}(object):'.format(a.title(), n),
+        '    """ A {} for {} and {}. """'.format(a, b, c),
+        '    limit = {}'.format(rnd.randint(0, 10000)),
+        '',
+        '    def __init__(self, {}=None, {}=0.5):'.format(b, c),
+        '        self.{0} = {0} or []'.format(b),
+        '        self.{0} = {0}'.format(c),
+        '',
+        '    def {}(self, items):'.format(a),
+        '        # Keep the {} items.'.format(b),
+        '        found = {}',
+        '        for i, item in enumerate(items):',
+        '            if item and (i % {}):'.format(rnd.randint(2, 9)),
+        "                found['{}_%d' % i] = item * self.{}".format(a, c),
+        '        return found',
+        '',
+        '',
+    ))
+
+
+def json_block(rnd, n):
+    """ Return a JSON document for file number `n`. """
+    return json.dumps(
+        [
+            {
+                'id': n * 100 + i,
+                'name': ' '.join(rnd.sample(WORDS, 2)),
+                'value': round(rnd.random() * 1000, 3),
+                'tags': rnd.sample(WORDS, 3),
+                'active': bool(i % 2),
+                'parent': None,
+            }
+            for i in range(rnd.randint(2, 12))
+        ],
+        indent=2,
+    )
+
+
+def shell_block(rnd, n):
+    """ Return a shell script for file number `n`. """
+    a, b = rnd.sample(WORDS, 2)
+    return '\n'.join((
+        '#!/bin/bash',
+        '# Script {}.'.format(n),
+        '{}="${{1:-{}}}"'.format(a, b),
+        'for f in *.txt; do',
+        '    if [[ -f "$f" ]] && grep -q "${}" "$f"; then'.format(a),
+        '        printf "%s: %d\\n" "$f" {}'.format(rnd.randint(0, 99)),
+        '    fi',
+        'done',
+        '',
+    ))
+
+
+def ini_block(rnd, n):
+    """ Return an INI file for file number `n`. """
+    lines = ['; Settings {}.'.format(n)]
+    for section in rnd.sample(WORDS, 3):
+        lines.append('[{}]'.format(section))
+        for key in rnd.sample(WORDS, 4):
+            lines.append('{} = {}'.format(key, rnd.randint(0, 9999)))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def write_python(path, rnd, size):
+    """ Write a Python file of about `size` bytes. """
+    written = 0
+    n = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            block = python_block(rnd, n)
+            f.write(block)
+            written += len(block)
+            n += 1
+
+
+def make_corpus(tmpdir):
+    """ Write the corpus files, which are the same for every run, and
+        return a dict of their paths.
+    """
+    rnd = random.Random(42)
+    paths = {
+        'big': os.path.join(tmpdir, 'big.py'),
+        'medium': os.path.join(tmpdir, 'medium.py'),
+        'small': os.path.join(tmpdir, 'small.txt'),
+        'stdin': os.path.join(tmpdir, 'stdin.txt'),
+    }
+    write_python(paths['big'], rnd, 4 * 1024 * 1024)
+    write_python(paths['medium'], rnd, 1024 * 1024)
+    write_python(paths['stdin'], rnd, 64 * 1024)
+
+    smalldir = os.path.join(tmpdir, 'small')
+    os.mkdir(smalldir)
+    kinds = (
+        ('py', lambda n: python_block(rnd, n) * 3),
+        ('json', lambda n: json_block(rnd, n)),
+        ('sh', lambda n: shell_block(rnd, n)),
+        ('ini', lambda n: ini_block(rnd, n)),
+    )
+    names = []
+    for n in range(400):
+        ext, make = kinds[n % len(kinds)]
+        name = os.path.join(smalldir, 'file{:03}.{}'.format(n, ext))
+        with open(name, 'w', encoding='utf-8') as f:
+            f.write(make(n))
+        names.append(name)
+    with open(paths['small'], 'w', encoding='utf-8') as f:
+        f.write('\n'.join(names))
+        f.write('\n')
+    return paths
+
+
+def run(cmd, env, stdin=None):
+    """ Run a command, reading all of its output through a pipe.
+        Returns (wall_seconds, cpu_seconds, max_rss_mib).
+    """
+    infile = open(stdin, 'rb') if stdin else subprocess.DEVNULL
+    try:
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd,
+            stdin=infile,
+            stdout=subprocess.PIPE,
+            env=env,
+        )
+        while proc.stdout.read(65536):
+            pass
+        proc.stdout.close()
+        _, status, usage = os.wait4(proc.pid, 0)
+        duration = time.perf_counter() - start
+    finally:
+        if stdin:
+            infile.close()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise RuntimeError(
+            'Failed ({}): {}'.format(proc.returncode, ' '.join(cmd))
+        )
+    # ru_maxrss is in KiB on Linux.
+    return (
+        duration,
+        usage.ru_utime + usage.ru_stime,
+        usage.ru_maxrss / 1024,
+    )
+
+
+def measure(cases, runs, tmpdir):
+    """ Run each case `runs` times, and return a dict of
+        {case: {'wall': secs, 'cpu': secs, 'rss': mib, 'calibration': secs}}.
+        Other processes can only make a run slower, so the times of the
+        fastest run are used, with the median max RSS.
+    """
+    paths = make_corpus(tmpdir)
+    env = dict(os.environ)
+    # Don't use or change the user's config, or their token cache.
+    env['XDG_CONFIG_HOME'] = os.path.join(tmpdir, 'config')
+    env['XDG_CACHE_HOME'] = os.path.join(tmpdir, 'cache')
+    results = {}
+    for name, args, stdin in cases:
+        cmd = [sys.executable, CCAT] + [a.format(**paths) for a in args]
+        stdin = paths[stdin] if stdin else None
+        # The first run warms up the disk cache, and isn't counted.
+        run(cmd, env, stdin=stdin)
+        samples = []
+        calibrations = []
+        for _ in range(runs):
+            samples.append(run(cmd, env, stdin=stdin))
+            calibrations.append(
+                run([sys.executable, '-c', CALIBRATE], env)[1]
+            )
+        wall, cpu, _ = min(samples)
+        results[name] = {
+            'wall': round(wall, 4),
+            'cpu': round(cpu, 4),
+            'rss': round(statistics.median(s[2] for s in samples), 4),
+            'calibration': round(min(calibrations), 4),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Print results next to the baseline, and return the number of
+        measurements that went over the tolerance.
+    """
+    failures = 0
+    print('{:<14} {:<5} {:>10} {:>10} {:>8}'.format(
+        'case', '', 'baseline', 'now', 'change'
+    ))
+    for name, result in results.items():
+        base = baseline.get(name)
+        # Baseline times are scaled by the machine's speed now.
+        speed = 1
+        if base and base.get('calibration'):
+            speed = result['calibration'] / base['calibration']
+        for key in ('wall', 'cpu', 'rss'):
+            now = result[key]
+            if not base:
+                print('{:<14} {:<5} {:>10} {:>10.3f} {:>8}'.format(
+                    name, key, '-', now, 'new'
+                ))
+                continue
+            was = base[key] if key == 'rss' else base[key] * speed
+            change = ((now - was) / was * 100) if was else 0
+            over = (
+                (change > tolerance[key]) and
+                ((now - was) > SLACK[key])
+            )
+            failures += over
+            print('{:<14} {:<5} {:>10.3f} {:>10.3f} {:>+7.1f}% {}{}'.format(
+                name,
+                key,
+                was,
+                now,
+                change,
+                UNITS[key],
+                '  FAIL (> {}%)'.format(tolerance[key]) if over else '',
+            ))
+    return failures
+
+
+def parse_tolerance(spec):
+    """ Parse a NAME=PERCENT,... spec into a tolerance dict. """
+    tolerance = dict(TOLERANCE)
+    for pair in spec.split(','):
+        key, _, value = pair.partition('=')
+        key = key.strip()
+        if key not in tolerance:
+            raise ValueError('Unknown tolerance name: {}'.format(key))
+        tolerance[key] = float(value)
+    return tolerance
+
+
+def main(args):
+    runs = 5
+    baselinefile = BASELINE
+    tolerance = dict(TOLERANCE)
+    update = False
+    keep = False
+    names = []
+    while args:
+        arg = args.pop(0)
+        if arg == '-n':
+            runs = int(args.pop(0))
+        elif arg == '-b':
+            baselinefile = args.pop(0)
+        elif arg == '-t':
+            tolerance = parse_tolerance(args.pop(0))
+        elif arg == '-u':
+            update = True
+        elif arg == '-k':
+            keep = True
+        elif arg.startswith('-'):
+            print(__doc__.strip())
+            return 0 if arg in ('-h', '--help') else 1
+        else:
+            names.append(arg)
+
+    known = [case[0] for case in CASES]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        print('Unknown cases: {}'.format(', '.join(unknown)))
+        return 1
+    cases = [case for case in CASES if (not names) or (case[0] in names)]
+
+    tmpdir = tempfile.mkdtemp(prefix='ccat-cli-')
+    try:
+        results = measure(cases, runs, tmpdir)
+    finally:
+        if keep:
+            print('Corpus kept in: {}'.format(tmpdir))
+        else:
+            shutil.rmtree(tmpdir)
+
+    if update:
+        baseline = {
+            'machine': platform.machine(),
+            'python': platform.python_version(),
+            'runs': runs,
+            'cases': results,
+        }
+        if names and os.path.exists(baselinefile):
+            # Only replace the cases that were run.
+            with open(baselinefile, 'r') as f:
+                old = json.load(f)
+            old['cases'].update(results)
+            baseline['cases'] = old['cases']
+        with open(baselinefile, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write('\n')
+        print('Wrote baseline: {}'.format(baselinefile))
+        return 0
+
+    try:
+        with open(baselinefile, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print('No baseline, write one with -u: {}'.format(baselinefile))
+        return 1
+    failures = compare(results, baseline['cases'], tolerance)
+    print('\nBaseline times were scaled by the calibration loop\'s speed.')
+    if failures:
+        print('\n{} measurement{} over the baseline.'.format(
+            failures,
+            '' if failures == 1 else 's',
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_fast.py
+    Times lexing with pygments lexers and with ccat's fast lexers
+    (`ccat.fast_lexer()`), and prints the speedup.
+
+    Usage:
+        tools/bench_fast.py [-n runs] [FILE...]
+
+    Without FILEs, generated JSON, Python, INI, and kernel log samples are
+    used. The best of `runs` (default: 3) is reported for each.
+"""
+import json
+import os
+import sys
+import time
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTDIR))
+
+import ccat  # noqa: E402
+from pygments import lexers  # noqa: E402
+
+
+def sample_json():
+    records = [
+        {
+            'id': i,
+            'name': 'item {}'.format(i),
+            'price': i * 1.25,
+            'tags': ['a', 'b', 'c\\n'],
+            'active': bool(i % 2),
+            'parent': None,
+        }
+        for i in range(20000)
+    ]
+    return json.dumps(records, indent=2)
+
+
+def sample_python():
+    with open(ccat.__file__, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def sample_ini():
+    return ''.join(
+        '[section{0}]\n'
+        '; comment {0}\n'
+        'name = value {0}\n'
+        'path = /usr/share/thing{0}\n'
+        'enabled = true\n\n'.format(i)
+        for i in range(20000)
+    )
+
+
+def sample_log():
+    return ''.join(
+        '[{:>5}.{:06}] usb 1-{}: new high-speed USB device number {} '
+        'using xhci_hcd\n'.format(i // 100, i % 1000000, i % 8, i)
+        for i in range(50000)
+    )
+
+
+SAMPLES = (
+    ('json', sample_json),
+    ('python', sample_python),
+    ('ini', sample_ini),
+    ('kmsg', sample_log),
+)
+
+
+def best_time(lexer, text, runs):
+    """ Return the best time to lex `text` out of `runs`, in seconds. """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in lexer.get_tokens_unprocessed(text):
+            pass
+        duration = time.perf_counter() - start
+        if (best is None) or (duration < best):
+            best = duration
+    return best
+
+
+def main(args):
+    runs = 3
+    if args[:1] == ['-n']:
+        runs, args = int(args[1]), args[2:]
+    if ('-h' in args) or ('--help' in args):
+        print(__doc__.strip())
+        return 0
+    if args:
+        samples = []
+        for path in args:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            lexer = lexers.get_lexer_for_filename(path, text)
+            samples.append((path, lexer, text))
+    else:
+        samples = [
+            (name, lexers.get_lexer_by_name(name), func())
+            for name, func in SAMPLES
+        ]
+
+    print('{:<24} {:>10} {:>10} {:>10} {:>8}'.format(
+        'sample', 'chars', 'pygments', 'fast', 'speedup'
+    ))
+    for name, lexer, text in samples:
+        fast = ccat.fast_lexer(lexer)
+        text = ccat.lexer_input(lexer, text)
+        slow_time = best_time(lexer, text, runs)
+        if fast is lexer:
+            fast_time = None
+        else:
+            fast_time = best_time(fast, text, runs)
+        print('{:<24} {:>10} {:>9.3f}s {:>10} {:>8}'.format(
+            name[-24:],
+            len(text),
+            slow_time,
+            '-' if fast_time is None else '{:.3f}s'.format(fast_time),
+            '-' if fast_time is None else '{:.1f}x'.format(
+                slow_time / fast_time
+            ),
+        ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
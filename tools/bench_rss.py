@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" bench_rss.py
+    Measures the peak memory (max RSS) and time of ccat.py for generated
+    INI files of several sizes, to show how memory use grows with file size
+    when rendering whole files, line ranges (--lines), and plain text.
+
+    Usage:
+        tools/bench_rss.py [-s sizes] [-k]
+
+    Options:
+        -s sizes : Comma-separated file sizes in MiB. Default: 1,4,16,64
+        -k       : Keep the generated files (in a temporary directory).
+
+    Whole files are decoded from a memory map and held for the lexer, and
+    the output is formatted a window at a time. Line ranges are rendered
+    from a memory map, in batches, because the INI lexer can resume at any
+    line (see `ccat.lexer_resumable()`).
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+CCAT = os.path.join(os.path.dirname(SCRIPTDIR), 'ccat.py')
+
+# Mode name, and extra ccat arguments, where {tail} is a line number 1000
+# lines before the end.
+MODES = (
+    ('full', ['-c']),
+    ('lines-head', ['-c', '--lines', '1:1000']),
+    ('lines-tail', ['-c', '--lines', '{tail}:']),
+    ('nocolors', ['-C']),
+)
+
+
+def make_file(path, size):
+    """ Write an INI file of about `size` bytes.
+        Returns the number of lines.
+    """
+    block = ''.join(
+        '[section{0}]\n'
+        '; Settings for section {0}.\n'
+        'name = value {0}\n'
+        'path = /usr/share/sample/{0}\n'
+        'enabled = true\n'
+        '\n'.format(i)
+        for i in range(1000)
+    )
+    lines = 0
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            f.write(block)
+            written += len(block.encode('utf-8'))
+            lines += block.count('\n')
+    return lines
+
+
+def run(args):
+    """ Run ccat.py with arguments, returning (seconds, max_rss_mib). """
+    env = dict(os.environ)
+    # Don't use or change the user's config.
+    env['XDG_CONFIG_HOME'] = tempfile.gettempdir()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, CCAT, '--nosave'] + args,
+        stdout=subprocess.DEVNULL,
+        env=env,
+    )
+    _, status, usage = os.wait4(proc.pid, 0)
+    duration = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        print('ccat failed ({}): {}'.format(proc.returncode, args))
+    # ru_maxrss is in KiB on Linux.
+    return duration, usage.ru_maxrss / 1024
+
+
+def main(args):
+    sizes = [1, 4, 16, 64]
+    keep = False
+    while args:
+        arg = args.pop(0)
+        if arg == '-s':
+            sizes = [float(s) for s in args.pop(0).split(',')]
+        elif arg == '-k':
+            keep = True
+        else:
+            print(__doc__.strip())
+            return 0 if arg in ('-h', '--help') else 1
+
+    tmpdir = tempfile.mkdtemp(prefix='ccat-rss-')
+    print('{:>8} {:<12} {:>10} {:>10}'.format(
+        'MiB', 'mode', 'seconds', 'max RSS'
+    ))
+    try:
+        for size in sizes:
+            path = os.path.join(tmpdir, 'sample_{}.ini'.format(size))
+            lines = make_file(path, int(size * 1024 * 1024))
+            tail = max(lines - 1000, 1)
+            for mode, modeargs in MODES:
+                modeargs = [a.format(tail=tail) for a in modeargs]
+                duration, rss = run([path] + modeargs)
+                print('{:>8} {:<12} {:>9.2f}s {:>7.1f}MiB'.format(
+                    size, mode, duration, rss
+                ))
+    finally:
+        if keep:
+            print('Files kept in: {}'.format(tmpdir))
+        else:
+            shutil.rmtree(tmpdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" fast_conformance.py
+    Checks that ccat's fast lexers (`ccat.fast_lexer()`) yield the same
+    tokens as the pygments lexers they replace, for a corpus of files.
+
+    Usage:
+        tools/fast_conformance.py [-l name] PATH...
+
+    Directories are searched recursively. Each file is lexed with the
+    pygments lexer for its name (or the -l lexer), and with its fast
+    version. Some JSON, INI, and kernel log edge cases are always checked
+    too. Lexer states saved at the start of each line (for --lines and
+    --incremental) are compared as well. Exits with 1 if any differ.
+"""
+import os
+import sys
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTDIR))
+
+import ccat  # noqa: E402
+from pygments import lexers  # noqa: E402
+from pygments.util import ClassNotFound  # noqa: E402
+
+# Bad or odd JSON, where JsonLexer's handling is easy to get wrong.
+JSON_CASES = (
+    '{"a": 1, "b": [true, false, null], "c": {"d": -1.5e+3}}',
+    '{"key" /* comment */ : "value", // end\n "k2"\n:\n[]}',
+    '"a" "b": 1',
+    '"\\u12" x", "\\u12\\"": 2',
+    '"\\uZZZZ" : "\\"\\\\"',
+    '{"unterminated": "value',
+    '/* unterminated comment',
+    '[1 / 2, 3/]',
+    '/',
+    '{"a":,::}',
+    'trustful --1-- 1...eee +1 .5 e5',
+    '{\u00a0"nbsp": 1}\r\n',
+    '',
+)
+# INI lines that use the IniLexer's other rules, or none of them.
+INI_CASES = (
+    '[section]\nname = value ; comment\nkey: value # comment\n',
+    '[a] b\n[c]  \t\n  indented = 1\n\n\n',
+    'quoted = "value" ; x\nsingle = \'it\'s\'\nopen = "never\n',
+    'path = C:\\dir\\\nmore = a \\ \n  continued\\\n',
+    'standalone\n=\n:\n a=b=c:d\n;\n#\n',
+    'tab\t=\tvalue\tmore  \nspaces = a  b  c   \n',
+    'nl\x0cff = 1\r\n[cr]\r\n\u3000wide = space\n',
+    'no newline = at end',
+)
+# Kernel log lines with and without levels, prefixes, and timestamps.
+KMSG_CASES = (
+    '[    0.000000] Linux version 6.1.0: (gcc) #1 SMP\n'
+    '[    1.234567] usb 1-1: new device\n',
+    '[    2.000000] warning: something\n[    3.0] Bug: oops\n'
+    '[    4.0] pci: error reading\n[5.0] audit: type=1400\n',
+    'kern  :info  : [    0.1] cpu: ok\nkern  :err   : [    0.2] x: y\n'
+    'kern  :warn  : [0.3] a\nkern  :debug : [0.4] b: c\n'
+    'kern  :notice: [0.5] d\nkern  :crit  : [0.6] e\n',
+    'no timestamp\n[not a number] x\n[ 1.0] no colon\n\n[ 2.0] \n',
+    '[ 1.0] warning at end without newline',
+)
+
+
+def compare(lexer, text, name):
+    """ Compare a lexer's tokens with its fast version's tokens.
+        Returns True if they are the same, or there is no fast version.
+    """
+    fast = ccat.fast_lexer(lexer)
+    if fast is lexer:
+        return True
+    text = ccat.lexer_input(lexer, text)
+    expected = list(lexer.get_tokens_unprocessed(text))
+    got = list(fast.get_tokens_unprocessed(text))
+    if got == expected:
+        return compare_states(lexer, fast, text, name)
+    for i, (a, b) in enumerate(zip(expected, got)):
+        if a != b:
+            break
+    else:
+        i = min(len(expected), len(got))
+    print('{} ({}): token {}'.format(name, lexer.name, i))
+    print('    pygments: {!r}'.format(expected[i:i + 3]))
+    print('        fast: {!r}'.format(got[i:i + 3]))
+    return False
+
+
+def compare_states(lexer, fast, text, name):
+    """ Compare the lexer states saved for each line by
+        `ccat.get_tokens_states()` for a lexer and its fast version.
+        Returns True if they are the same, or states aren't supported.
+    """
+    if not ccat.lexer_states_supported(lexer):
+        return True
+    expected = {}
+    got = {}
+    for _ in ccat.get_tokens_states(lexer, text, states=expected):
+        pass
+    for _ in ccat.get_tokens_states(fast, text, states=got):
+        pass
+    if got == expected:
+        return True
+    offset = min(
+        offset
+        for offset in set(expected).union(got)
+        if expected.get(offset, None) != got.get(offset, None)
+    )
+    print('{} ({}): line state at offset {}'.format(name, lexer.name, offset))
+    print('    pygments: {!r}'.format(expected.get(offset, None)))
+    print('        fast: {!r}'.format(got.get(offset, None)))
+    return False
+
+
+def iter_files(paths):
+    """ Yield file paths from files and directories. """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for filename in sorted(files):
+                yield os.path.join(root, filename)
+
+
+def main(args):
+    lexername = None
+    if args[:1] == ['-l']:
+        lexername, args = args[1], args[2:]
+    if (not args) or ('-h' in args) or ('--help' in args):
+        print(__doc__.strip())
+        return 0 if args else 1
+
+    failed = checked = 0
+    for name, cases in (
+            ('json', JSON_CASES),
+            ('ini', INI_CASES),
+            ('kmsg', KMSG_CASES)):
+        case_lexer = lexers.get_lexer_by_name(name)
+        for i, text in enumerate(cases):
+            checked += 1
+            if not compare(case_lexer, text, '{} case {}'.format(name, i)):
+                failed += 1
+
+    byclass = {}
+    for path in iter_files(args):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            if lexername:
+                lexer = lexers.get_lexer_by_name(lexername)
+            else:
+                lexer = lexers.get_lexer_for_filename(path, text)
+        except (ClassNotFound, UnicodeDecodeError, EnvironmentError):
+            continue
+        # Reuse Lexer() instances, like ccat does.
+        lexer = byclass.setdefault(type(lexer), lexer)
+        checked += 1
+        if not compare(lexer, text, path):
+            failed += 1
+    print('Checked {} files/cases, {} differed.'.format(checked, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" incremental_check.py
+    Checks that incremental lexing (`ccat.Printer(incremental=True)`)
+    yields the same tokens as lexing the whole file, for a corpus of files
+    with random edits.
+
+    Usage:
+        tools/incremental_check.py [-a] [-l name] [-n edits] PATH...
+
+    Options:
+        -a       : Also check lexers that `ccat.lexer_resumable()` rules
+                   out, to see why they are.
+        -l name  : Use this lexer for all files.
+        -n edits : Random edits per file. Default: 20
+
+    Directories are searched recursively. Each file is lexed once, then
+    lines are deleted, copied, or get quotes and brackets added, one edit
+    at a time. After each edit the incremental tokens are compared with a
+    full lex. Exits with 1 if any tokens differ.
+"""
+import os
+import random
+import sys
+
+SCRIPTDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPTDIR))
+
+import ccat  # noqa: E402
+from pygments import lexers  # noqa: E402
+from pygments.formatters import NullFormatter  # noqa: E402
+from pygments.util import ClassNotFound  # noqa: E402
+
+# Text added to lines, to open or close strings, comments, and blocks.
+SNIPPETS = (
+    '"', "'", '"""', "'''", '`', '/*', '*/', '<!--', '-->', '#', '//',
+    '{', '}', '[', ']', '(', ')', '\\', '<<EOF', 'EOF', '=', ';',
+)
+
+
+def edit(rnd, lines):
+    """ Make a random edit to a list of lines, in place.
+        Returns a description of the edit.
+    """
+    i = rnd.randrange(len(lines))
+    kind = rnd.randrange(4)
+    if (kind == 0) and (len(lines) > 1):
+        del lines[i]
+        return 'deleted line {}'.format(i + 1)
+    if kind == 1:
+        j = rnd.randrange(len(lines))
+        lines.insert(i, lines[j])
+        return 'copied line {} to {}'.format(j + 1, i + 1)
+    snippet = rnd.choice(SNIPPETS)
+    if kind == 2:
+        lines[i] = snippet + lines[i]
+        return 'added {!r} to the start of line {}'.format(snippet, i + 1)
+    lines[i] = lines[i] + snippet
+    return 'added {!r} to the end of line {}'.format(snippet, i + 1)
+
+
+def check(lexer, text, name, edits, rnd):
+    """ Lex a file incrementally after each of `edits` random edits, and
+        compare the tokens with a full lex.
+        Returns True if they are always the same.
+    """
+    printer = ccat.Printer(formatter=NullFormatter(), incremental=True)
+    list(printer.lex(text, lexer, name=name))
+    lines = text.split('\n')
+    done = []
+    for _ in range(edits):
+        done.append(edit(rnd, lines))
+        text = '\n'.join(lines)
+        got = list(printer.lex(text, lexer, name=name))
+        expected = list(lexer.get_tokens(text))
+        if got == expected:
+            continue
+        for i, (a, b) in enumerate(zip(expected, got)):
+            if a != b:
+                break
+        else:
+            i = min(len(expected), len(got))
+        print('{} ({}): tokens differ at token {}, after:'.format(
+            name,
+            lexer.name,
+            i,
+        ))
+        for desc in done:
+            print('    {}'.format(desc))
+        print('    expected: {!r}'.format(expected[i:i + 3]))
+        print('         got: {!r}'.format(got[i:i + 3]))
+        return False
+    return True
+
+
+def iter_files(paths):
+    """ Yield file paths, searching directories recursively. """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                yield os.path.join(root, filename)
+
+
+def main(args):
+    lexername = None
+    edits = 20
+    paths = []
+    while args:
+        arg = args.pop(0)
+        if arg == '-a':
+            # Check lexers that would not be lexed incrementally.
+            ccat.lexer_resumable = ccat.lexer_states_supported
+        elif arg == '-l':
+            lexername = args.pop(0)
+        elif arg == '-n':
+            edits = int(args.pop(0))
+        elif arg.startswith('-'):
+            print(__doc__.strip())
+            return 0 if arg in ('-h', '--help') else 1
+        else:
+            paths.append(arg)
+    if not paths:
+        print(__doc__.strip())
+        return 1
+
+    rnd = random.Random(0)
+    failed = checked = 0
+    byclass = {}
+    for path in iter_files(paths):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            if lexername:
+                lexer = lexers.get_lexer_by_name(lexername)
+            else:
+                lexer = lexers.get_lexer_for_filename(path, text)
+        except (ClassNotFound, UnicodeDecodeError, EnvironmentError):
+            continue
+        # Reuse Lexer() instances, like ccat does.
+        lexer = byclass.setdefault(type(lexer), lexer)
+        if (not text) or (not ccat.lexer_resumable(lexer)):
+            continue
+        checked += 1
+        if not check(lexer, text, os.path.abspath(path), edits, rnd):
+            failed += 1
+    print('Checked {} files, {} differed.'.format(checked, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))